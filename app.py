@@ -1,10 +1,14 @@
-from dash import Dash, dcc, html, Input, Output
+from dash import Dash, dcc, html, dash_table, Input, Output, ClientsideFunction, no_update
 import dash_bootstrap_components as dbc
 
-from dash_utils import ANNOTATION_CATEGORIES, create_linechart, create_histograms_differences, \
-    create_histograms_annotations, create_heatmap_kappa, create_contingency_heatmap
-from data_utils import get_dfs
-from flask_caching import Cache
+import os
+
+import refresh_utils
+from dash_utils import ANNOTATION_CATEGORIES, ITEM_LIMIT, ITEM_TABLE_COLUMNS, create_placeholder_figure, figure_json, \
+    create_group_heatmap, heatmap_drill_in_target, top_items
+from metrics_utils import snapshot, timed
+from refresh_utils import current_snapshot, request_refresh
+from flask_compress import Compress
 
 """
 Create a grouped bar chart of annotation differences per each round
@@ -16,117 +20,322 @@ Create a grouped bar chart of annotation differences per each round
 # ===== UPDATE AXES =====
 
 app = Dash(__name__)
-cache = Cache(app.server, config={
-    'CACHE_TYPE': 'simple',
-})
 app.config.suppress_callback_exceptions = True
 
 server = app.server
 
-TIMEOUT = 60
+# With COMPRESS_RESPONSES, responses (layout, callback results, figure payloads, assets) are compressed with brotli
+# or gzip, whichever the browser accepts. Set COMPRESS_RESPONSES=0 to serve them uncompressed
+COMPRESS_RESPONSES = os.environ.get('COMPRESS_RESPONSES', '1') != '0'
+if COMPRESS_RESPONSES:
+    server.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+    Compress(server)
+
+# With LAZY_STARTUP, the server starts right away and loads data / builds figures in the background,
+# while the page shows placeholders. Set LAZY_STARTUP=0 to build everything at import time instead
+LAZY_STARTUP = os.environ.get('LAZY_STARTUP', '1') != '0'
 
+# With CLIENTSIDE_CATEGORIES, the figure data for every category is sent once in figure-store and the browser
+# switches categories by itself (assets/category_switch.js). Set CLIENTSIDE_CATEGORIES=0 to switch on the server
+CLIENTSIDE_CATEGORIES = os.environ.get('CLIENTSIDE_CATEGORIES', '1') != '0'
 
-@cache.memoize(timeout=TIMEOUT)  # Memoize to avoid re-loading data
+
+# Callbacks serve the last good snapshot of the data and of every figure right away. Every worker maps the same
+# on-disk copy of the get_dfs outputs, and refresh_utils rebuilds the snapshot in the background (recomputing the
+# outputs in one worker only) when the annotation files change
 def query_data():
-    print('querying data')
-    return get_dfs()
+    return current_snapshot().data
 
 
-app.layout = html.Div(children=[
-    html.H1(children='Common Law Annotations'),
+def _query_all_figures():
+    return current_snapshot().figures
 
-    html.H2(children='''
-        An interactive chart for Common Law Annotations
-    '''),
 
-    html.H3(children="Inter-annotator Agreement per Round"),
-    dcc.Graph(
-        id='linechart-graph',
-        figure=create_linechart(query_data()[1]),
+def query_items(category, round, group, k):
+    snapshot = current_snapshot()
+    return top_items(snapshot.data, category, round, group, k, snapshot.index)
 
-    ),
 
-    html.Div(
-        [
-            "Annotation Category:",
-            # Dropdown for category
-            dcc.Dropdown(
-                id='category-dropdown',
-                options=ANNOTATION_CATEGORIES,
-                value=ANNOTATION_CATEGORIES[0],  # Default value
-                style={'width': '50vw'}
-            ),
-        ]
-    ),
-
-    html.H3("Intra-group Inter-Annotator Agreement per Round"),
-    dcc.Graph(
-        id='heatmap-graph',
-        figure=create_heatmap_kappa(query_data()[3], 'Appropriateness'),
-        style={'width': '90vw', 'height': '60vh'}  # Set graph size
-    ),
-
-    html.H3("Annotation Contigency Tables"),
-    dcc.Graph(
-        id='contingency-graph',
-        figure=create_contingency_heatmap(query_data()[4], query_data()[1], 'Appropriateness'),
-        style={'width': '90vw', 'height': '90vh'}  # Set graph size
-    ),
-
-    # Wrap around Div to place graphs side-by-side
-
-    html.Div(children=[
-        html.H3("Number of Annotations per Round (within-group)"),
+def query_figures(category):
+    return _query_all_figures()['figures'][category]
+
+
+# Set once the data is loaded and every figure is built
+data_ready = refresh_utils.ready
+
+
+@timed('warm_up')
+def warm_up():
+    # Without LAZY_STARTUP, wait for the first snapshot (and raise if it couldn't be built)
+    future = request_refresh()
+    if not LAZY_STARTUP:
+        future.result()
+
+
+def serve_layout():
+    # Until the data is ready, every graph gets a placeholder and warmup-interval polls for the real figures
+    ready = data_ready.is_set()
+    if not ready:
+        # Retry a warm-up that failed (current_snapshot, which checks for changes, only runs once ready)
+        request_refresh()
+    # One snapshot for the whole page, even if a refresh swaps in a new one meanwhile
+    figures = _query_all_figures() if ready else None
+    # In clientside mode, the browser fills in the category figures from figure-store right away
+    if ready and not CLIENTSIDE_CATEGORIES:
+        category_figures = figures['figures'][ANNOTATION_CATEGORIES[0]]
+    else:
+        category_figures = [create_placeholder_figure()] * 5
+
+    return html.Div(children=[
+        html.H1(children='Common Law Annotations'),
+
+        html.H2(children='''
+            An interactive chart for Common Law Annotations
+        '''),
+
+        html.H3(children="Inter-annotator Agreement per Round"),
+        dcc.Graph(
+            id='linechart-graph',
+            figure=figures['linechart'] if ready else create_placeholder_figure(),
+
+        ),
+
+        html.H3(children="Inter-annotator Agreement per Round (all annotators)"),
         dcc.Graph(
-            id='annotations-graph',
-            figure=create_histograms_annotations(query_data()[2], 'Appropriateness'),
-            # style={'display': 'inline-block', 'width': '50vw'},
+            id='multi-rater-graph',
+            figure=figures['multi_rater'] if ready else create_placeholder_figure(),
+        ),
+
+        html.Div(
+            [
+                "Annotation Category:",
+                # Dropdown for category
+                dcc.Dropdown(
+                    id='category-dropdown',
+                    options=ANNOTATION_CATEGORIES,
+                    value=ANNOTATION_CATEGORIES[0],  # Default value
+                    style={'width': '50vw'}
+                ),
+            ]
         ),
 
-        html.H3("Absolute Difference in Annotations per Round (within-group)"),
+        html.H3("Intra-group Inter-Annotator Agreement per Round"),
         dcc.Graph(
-            id='differences-graph',
-            figure=create_histograms_differences(query_data()[0], 'Appropriateness'),
+            id='heatmap-graph',
+            figure=category_figures[2],
+            style={'width': '90vw', 'height': '60vh'}  # Set graph size
         ),
 
-    ]),
+        # Raters of the groups clicked in the heatmap above
+        dcc.Graph(
+            id='heatmap-drill-graph',
+            figure=create_placeholder_figure('Click a cell of the heatmap above to show the raters of its groups'),
+            style={'width': '60vw', 'height': '60vh'}
+        ),
 
-    # Store dropdown selection on local browser session
-    dcc.Store(id='filter-store')
+        html.H3("Annotation Contigency Tables"),
+        dcc.Graph(
+            id='contingency-graph',
+            figure=category_figures[3],
+            style={'width': '90vw', 'height': '90vh'}  # Set graph size
+        ),
 
-])
+        # Wrap around Div to place graphs side-by-side
+
+        html.Div(children=[
+            html.H3("Number of Annotations per Round (within-group)"),
+            dcc.Graph(
+                id='annotations-graph',
+                figure=category_figures[1],
+                # style={'display': 'inline-block', 'width': '50vw'},
+            ),
+
+            html.H3("Absolute Difference in Annotations per Round (within-group)"),
+            dcc.Graph(
+                id='differences-graph',
+                figure=category_figures[0],
+            ),
+
+        ]),
+
+        html.H3("Annotator Consistency across Rounds"),
+        dcc.Graph(
+            id='trajectories-graph',
+            figure=category_figures[4],
+        ),
+
+        html.H3("Most Contentious Items"),
+        html.Div(
+            [
+                "Round:",
+                dcc.Dropdown(id='items-round-dropdown', placeholder='All rounds', style={'width': '15vw'}),
+                "Group:",
+                dcc.Dropdown(id='items-group-dropdown', value=0, clearable=False, style={'width': '15vw'}),
+                "Items:",
+                dcc.Input(id='items-count', type='number', value=10, min=1, max=ITEM_LIMIT),
+            ],
+            style={'display': 'flex', 'gap': '1em', 'alignItems': 'center'}
+        ),
+        dash_table.DataTable(
+            id='items-table',
+            columns=ITEM_TABLE_COLUMNS,
+            data=[],
+            style_cell={'textAlign': 'left', 'whiteSpace': 'pre-line', 'maxWidth': '30vw'},
+        ),
+
+        # Store dropdown selection on local browser session (server-side category switching only)
+        *([] if CLIENTSIDE_CATEGORIES else [dcc.Store(id='filter-store')]),
+
+        # Figure data for every category, when switching categories in the browser
+        dcc.Store(id='figure-store', data=figures['payload'] if ready and CLIENTSIDE_CATEGORIES else None),
+
+        # Polls until the data is ready, then disables itself
+        dcc.Interval(id='warmup-interval', interval=1000, disabled=ready),
+
+    ])
+
+
+# Pool processes started by the forkserver (see data_utils.load_workbooks) import the main script as __mp_main__,
+# and must not start a refresh of their own
+if __name__ != '__mp_main__':
+    warm_up()
+
+app.layout = serve_layout
+
+
+# Readiness check for health checks / load balancers
+@server.route('/healthz')
+def healthz():
+    ready = data_ready.is_set()
+    if not ready:
+        request_refresh()
+    return {'ready': ready}, 200 if ready else 503
+
+
+# Stage timings, callback latencies and cache hit / miss counts of this worker, see metrics_utils
+@server.route('/metrics')
+def metrics():
+    return snapshot()
 
 
 # ==== LOAD DATA ====
 
 # ===== CALLBACKS FOR DROPDOWNS =====
 
-# Store dropdown values to local session storage
 @app.callback(
-    Output('filter-store', 'data'),
-    Input('category-dropdown', 'value')
+    Output('linechart-graph', 'figure'),
+    Output('multi-rater-graph', 'figure'),
+    Output('figure-store', 'data'),
+    Output('warmup-interval', 'disabled'),
+    Input('warmup-interval', 'n_intervals'),
+    prevent_initial_call=True,
 )
-def update_dropdown_values(category):
-    return {
-        'category': category
-    }
+@timed('callback.update_when_ready')
+def update_when_ready(n_intervals):
+    # Swap the placeholders for the real figures once warm_up is done
+    if not data_ready.is_set():
+        # Every poll retries a failed warm-up, at most once per REFRESH_INTERVAL
+        request_refresh()
+        return no_update, no_update, no_update, False
+    figures = _query_all_figures()
+    return figures['linechart'], figures['multi_rater'], figures['payload'] if CLIENTSIDE_CATEGORIES else None, True
 
 
 @app.callback(
-    Output('differences-graph', 'figure'),
-    Output('annotations-graph', 'figure'),
-    Output('heatmap-graph', 'figure'),
-    Output('contingency-graph', 'figure'),
-    Input('filter-store', 'data'),
+    Output('heatmap-drill-graph', 'figure'),
+    Input('heatmap-graph', 'clickData'),
+    Input('category-dropdown', 'value'),
+    prevent_initial_call=True,
 )
-def update_category_chart(filter_json):
-    return (
-        create_histograms_differences(query_data()[0], filter_json['category']),
-        # skips kappa linechart - no categorical selections
-        create_histograms_annotations(query_data()[2], filter_json['category']),
-        create_heatmap_kappa(query_data()[3], filter_json['category']),
-        create_contingency_heatmap(query_data()[4], query_data()[1], filter_json['category']),
+@timed('callback.update_heatmap_drill_in')
+def update_heatmap_drill_in(click_data, category):
+    # Drill into the groups of the clicked heatmap cell, at rater level
+    if click_data is None or not data_ready.is_set():
+        return no_update
+
+    data = query_data()
+    round, groups = heatmap_drill_in_target(data.group_kappa, data.raters, click_data['points'][0])
+    return figure_json(create_group_heatmap(data.group_kappa, data.raters, category, round, groups))
+
+
+@app.callback(
+    Output('items-round-dropdown', 'options'),
+    Output('items-group-dropdown', 'options'),
+    Input('warmup-interval', 'disabled'),  # Fires again when the data becomes ready
+    Input('items-round-dropdown', 'value'),
+)
+@timed('callback.update_item_filters')
+def update_item_filters(ready, round):
+    if not data_ready.is_set():
+        return [], []
+
+    raters = query_data().raters
+    rounds = sorted(raters['round'].unique())
+    if round is not None:
+        raters = raters[raters['round'] == round]
+    groups = sorted(raters['group'].unique())
+
+    return ([{'label': f'Round {round_no}', 'value': int(round_no)} for round_no in rounds],
+            [{'label': 'All groups', 'value': 0}]
+            + [{'label': f'Group {group_no}', 'value': int(group_no)} for group_no in groups])
+
+
+@app.callback(
+    Output('items-table', 'data'),
+    Input('category-dropdown', 'value'),
+    Input('items-round-dropdown', 'value'),
+    Input('items-group-dropdown', 'value'),
+    Input('items-count', 'value'),
+    Input('warmup-interval', 'disabled'),
+)
+@timed('callback.update_item_table')
+def update_item_table(category, round, group, k, ready):
+    # Top k items of the precomputed disagreement index, no workbook is read
+    if not data_ready.is_set() or not k:
+        return []
+    return query_items(category, round, group, int(k))
+
+
+if CLIENTSIDE_CATEGORIES:
+    # differences, annotations, heatmap, contingency, trajectories, patched together in the browser from figure-store
+    app.clientside_callback(
+        ClientsideFunction(namespace='figures', function_name='switchCategory'),
+        Output('differences-graph', 'figure'),
+        Output('annotations-graph', 'figure'),
+        Output('heatmap-graph', 'figure'),
+        Output('contingency-graph', 'figure'),
+        Output('trajectories-graph', 'figure'),
+        Input('category-dropdown', 'value'),
+        Input('figure-store', 'data'),
     )
+else:
+    # Store dropdown values to local session storage
+    @app.callback(
+        Output('filter-store', 'data'),
+        Input('category-dropdown', 'value')
+    )
+    @timed('callback.update_dropdown_values')
+    def update_dropdown_values(category):
+        return {
+            'category': category
+        }
+
+    @app.callback(
+        Output('differences-graph', 'figure'),
+        Output('annotations-graph', 'figure'),
+        Output('heatmap-graph', 'figure'),
+        Output('contingency-graph', 'figure'),
+        Output('trajectories-graph', 'figure'),
+        Input('filter-store', 'data'),
+        Input('warmup-interval', 'disabled'),  # Fires again when the data becomes ready
+    )
+    @timed('callback.update_category_chart')
+    def update_category_chart(filter_json, ready):
+        if not data_ready.is_set():
+            return [no_update] * 5
+
+        # differences, annotations, heatmap, contingency, trajectories (skips kappa linechart - not per category)
+        return query_figures(filter_json['category'])
 
 
 if __name__ == '__main__':
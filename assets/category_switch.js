@@ -0,0 +1,20 @@
+// Clientside category switching, see app.py (CLIENTSIDE_CATEGORIES) and dash_utils.create_figure_payload
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    figures: {
+        // Rebuilds the differences, annotations, heatmap, contingency and trajectories figures for a category
+        switchCategory: function(category, payload) {
+            if (!payload || !payload.patches[category]) {
+                return Array(5).fill(window.dash_clientside.no_update);
+            }
+
+            return payload.base.map(function(base, idx) {
+                var patch = payload.patches[category][idx];
+                var data = patch.merge ? base.data.map(function(trace, traceIdx) {
+                    return Object.assign({}, trace, patch.data[traceIdx]);
+                }) : patch.data;
+
+                return {data: data, layout: Object.assign({}, base.layout, patch.layout)};
+            });
+        }
+    }
+});
@@ -0,0 +1,285 @@
+"""
+Benchmarks the annotation pipeline on synthetic data
+
+Writes an annotations tree shaped like the real one (roundN/groupG/[Name]annotation_roundN.xlsx) with a
+configurable number of rounds, groups, raters per group and items, points data_utils at it, and times every
+stage: listing and parsing the workbooks (without and with the .npz cache), the tensor, each calculate_*
+function, the incremental get_versioned_dfs, the shared store and every dash_utils figure builder.
+Each stage reports its best time, throughput (annotations per second) and peak traced memory.
+
+Usage:
+    python benchmark.py [--rounds 6] [--groups 4] [--raters 2] [--items 50 400 3200] [--repeat 3]
+                        [--json results.json] [--compare baseline.json]
+Passing several --items values runs one benchmark per size, to see how each stage scales.
+With --compare, stages that got slower than --tolerance times the baseline are flagged.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import warnings
+
+import numpy as np
+import openpyxl
+
+import dash_utils
+import data_utils
+import store_utils
+from data_utils import ANNOTATION_CATEGORIES, LABELS
+
+MODELS = ['groundtruth', 'blender23b', 'blender9b', 'dialogpt']
+
+
+def generate_annotations(directory, rounds, groups, raters, items, missing_rate=0.01, seed=0):
+    """
+    Writes a synthetic annotations tree under directory. Raters of a round score the same items: each item has
+    a true label per category, and each rater is off by one now and then, so kappas land in a realistic range
+    """
+    rng = np.random.default_rng(seed)
+
+    for ROUND_NUMBER in range(1, rounds + 1):
+        truth = rng.integers(1, len(LABELS) + 1, size=(items, len(ANNOTATION_CATEGORIES)))
+        for GROUP_NO in range(1, groups + 1):
+            FINAL_PATH = os.path.join(directory, f'round{ROUND_NUMBER}', f'group{GROUP_NO}')
+            os.makedirs(FINAL_PATH, exist_ok=True)
+
+            for rater in range(raters):
+                noise = rng.choice([-1, 0, 0, 0, 1], size=truth.shape)
+                scores = np.clip(truth + noise, LABELS[0], LABELS[-1]).astype(float)
+                scores[rng.random(scores.shape) < missing_rate] = np.nan
+
+                # Like the real workbooks: long text columns first, scores stored as floats
+                workbook = openpyxl.Workbook(write_only=True)
+                sheet = workbook.create_sheet('Sheet1')
+                sheet.append(['prompt', 'response', 'model'] + ANNOTATION_CATEGORIES)
+                for item, row in enumerate(scores):
+                    sheet.append([f'A: Prompt {item} of round {ROUND_NUMBER}. ' * 4,
+                                  f'Response to prompt {item}. ' * 3,
+                                  MODELS[item % len(MODELS)]]
+                                 + [None if np.isnan(value) else value for value in row])
+                workbook.save(os.path.join(FINAL_PATH,
+                                           f'[R{ROUND_NUMBER}G{GROUP_NO}N{rater}]annotation_round{ROUND_NUMBER}.xlsx'))
+
+
+@contextlib.contextmanager
+def annotations_tree(directory):
+    # Points data_utils and store_utils at a generated tree, with fresh caches, and restores them afterwards
+    saved_data = {name: getattr(data_utils, name) for name in ['ANNOTATIONS_DIR', 'CACHE_DIR']}
+    saved_store = store_utils.STORE_DIR
+
+    data_utils.ANNOTATIONS_DIR = directory
+    data_utils.CACHE_DIR = os.path.join(directory, '.annotation_cache')
+    store_utils.STORE_DIR = os.path.join(directory, '.annotation_store')
+    reset_state()
+    try:
+        yield
+    finally:
+        for name, value in saved_data.items():
+            setattr(data_utils, name, value)
+        store_utils.STORE_DIR = saved_store
+        reset_state()
+
+
+def reset_state():
+    # Forgets everything the catalog, get_versioned_dfs and get_shared_dfs kept in memory
+    data_utils._listings.clear()
+    data_utils._round_metrics.clear()
+    data_utils._latest.update(version=None, data=None)
+    store_utils._mapped.update(version=None, data=None)
+
+
+def measure(func, repeat, setup=None):
+    """
+    Runs func repeat times and returns (best seconds, mean seconds, peak traced bytes, last result).
+    Memory is traced in one extra run, so tracing doesn't slow down the timed ones.
+    The pipeline's own progress prints and warnings are silenced
+    """
+    times = []
+    result = None
+    with contextlib.redirect_stdout(io.StringIO()), warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        for _ in range(repeat):
+            if setup is not None:
+                setup()
+            start = time.perf_counter()
+            result = func()
+            times.append(time.perf_counter() - start)
+
+        if setup is not None:
+            setup()
+        tracemalloc.start()
+        try:
+            func()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    return min(times), float(np.mean(times)), peak, result
+
+
+def run_benchmark(directory, rounds, groups, raters, items, repeat):
+    """
+    Times every stage on the tree in directory. Returns a list of result dicts, one per stage
+    """
+    annotations = rounds * groups * raters * items * len(ANNOTATION_CATEGORIES)
+    results = []
+
+    def stage(name, func, setup=None):
+        try:
+            best, mean, peak, result = measure(func, repeat, setup)
+        except Exception as error:  # A builder that doesn't scale to this shape is a result too
+            results.append({'stage': name, 'error': f'{type(error).__name__}: {error}'})
+            print(f'{name:<40} failed: {type(error).__name__}: {error}')
+            return None
+
+        results.append({'stage': name, 'best': best, 'mean': mean, 'throughput': annotations / best,
+                        'peak_mb': peak / 2 ** 20})
+        print(f'{name:<40} {best * 1000:>10.1f} ms {mean * 1000:>10.1f} ms {annotations / best:>14,.0f}/s '
+              f'{peak / 2 ** 20:>9.1f} MB')
+        return result
+
+    def clear_cache():
+        shutil.rmtree(data_utils.CACHE_DIR, ignore_errors=True)
+
+    def clear_catalog():
+        reset_state()
+        clear_cache()
+
+    def clear_store():
+        reset_state()
+        shutil.rmtree(store_utils.STORE_DIR, ignore_errors=True)
+
+    print(f'{"stage":<40} {"best":>13} {"mean":>13} {"annotations":>16} {"peak":>12}')
+
+    with annotations_tree(directory):
+        # Ingestion
+        stage('annotation_catalog (cold)', data_utils.annotation_catalog, setup=clear_catalog)
+        catalog = stage('annotation_catalog (warm)', data_utils.annotation_catalog)
+        stage('fingerprint_annotations', lambda: data_utils.fingerprint_annotations(catalog))
+        stage('load_workbooks (no cache)', lambda: data_utils.load_workbooks(catalog, use_cache=False))
+        stage('load_workbooks (cold cache)', lambda: data_utils.load_workbooks(catalog), setup=clear_cache)
+        stage('load_workbooks (warm cache)', lambda: data_utils.load_workbooks(catalog))
+        data = stage('read_data', data_utils.read_data)
+        scores, meta = stage('read_data (tensor)', lambda: data_utils.read_data(as_tensor=True))
+
+        # Metrics
+        stage('to_tensor', lambda: data_utils.to_tensor(data))
+        stage('pairwise_kappa', lambda: data_utils.pairwise_kappa(scores))
+        for func in [data_utils.calculate_differences, data_utils.calculate_cohen_kappa,
+                     data_utils.calculate_group_kappa, data_utils.calculate_count,
+                     data_utils.create_contingency_table, data_utils.calculate_multi_rater_agreement,
+                     data_utils.calculate_item_disagreement, data_utils.calculate_annotator_consistency]:
+            stage(func.__name__, lambda: func(scores, meta))
+        stage('compute_metrics', lambda: data_utils.compute_metrics(scores, meta))
+
+        # Entry points
+        stage('get_versioned_dfs (cold)', data_utils.get_versioned_dfs, setup=reset_state)
+        stage('get_versioned_dfs (warm)', data_utils.get_versioned_dfs)
+        stage('get_shared_dfs (write store)', store_utils.get_shared_dfs, setup=clear_store)
+        stage('get_shared_dfs (map store)', store_utils.get_shared_dfs,
+              setup=lambda: store_utils._mapped.update(version=None, data=None))
+        dfs = stage('get_shared_dfs (warm)', store_utils.get_shared_dfs)[1]
+
+        # Figures
+        category = ANNOTATION_CATEGORIES[0]
+        stage('create_linechart', lambda: dash_utils.create_linechart(dfs.kappa))
+        stage('create_multi_rater_linechart', lambda: dash_utils.create_multi_rater_linechart(dfs.multi_rater))
+        stage('create_histograms_differences', lambda: dash_utils.create_histograms_differences(dfs.differences,
+                                                                                               category))
+        stage('create_histograms_annotations', lambda: dash_utils.create_histograms_annotations(dfs.annotations,
+                                                                                               category))
+        stage('create_heatmap_kappa', lambda: dash_utils.create_heatmap_kappa(dfs.group_kappa, category, dfs.raters))
+        # Drill into the first two groups of the first round, like a click on the heatmap
+        first_round = next(iter(dfs.group_kappa), None)
+        drill_groups = sorted(dfs.raters.loc[dfs.raters['round'] == first_round, 'group'].unique())[:2]
+        stage('create_group_heatmap', lambda: dash_utils.create_group_heatmap(dfs.group_kappa, dfs.raters, category,
+                                                                             first_round, drill_groups))
+        stage('create_contingency_heatmap', lambda: dash_utils.create_contingency_heatmap(dfs.contingency, dfs.kappa,
+                                                                                         category))
+        stage('create_annotator_trajectories', lambda: dash_utils.create_annotator_trajectories(dfs.annotators,
+                                                                                               category))
+        figures = stage('create_category_figures', lambda: dash_utils.create_category_figures(dfs))
+        if figures is not None:
+            stage('create_figure_payload', lambda: dash_utils.create_figure_payload(figures))
+            payload = json.dumps(dash_utils.create_figure_payload(figures))
+            print(f'figure payload: {len(payload) / 2 ** 20:.2f} MB')
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    # Prints the stages that got slower than tolerance times their baseline
+    baseline_times = {(run['config'], entry['stage']): entry.get('best')
+                      for run in baseline for entry in run['results']}
+    regressions = 0
+    for run in results:
+        for entry in run['results']:
+            before = baseline_times.get((run['config'], entry['stage']))
+            if before is None or entry.get('best') is None:
+                continue
+            ratio = entry['best'] / before
+            if ratio > tolerance:
+                regressions += 1
+                print(f'REGRESSION {run["config"]} {entry["stage"]}: {before * 1000:.1f} ms -> '
+                      f'{entry["best"] * 1000:.1f} ms ({ratio:.2f}x)')
+
+    print(f'{regressions} regression(s) against the baseline')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the annotation pipeline on synthetic data')
+    parser.add_argument('--rounds', type=int, default=6, help='Rounds to generate')
+    parser.add_argument('--groups', type=int, default=4, help='Groups per round')
+    parser.add_argument('--raters', type=int, default=2, help='Raters per group')
+    parser.add_argument('--items', type=int, nargs='+', default=[50],
+                        help='Items per round, one benchmark per value')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs per stage, the best one is reported')
+    parser.add_argument('--data-dir', help='Generate the trees here and keep them (default: a temporary directory)')
+    parser.add_argument('--json', help='Write the results to this file')
+    parser.add_argument('--compare', help='Results file of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=1.2, help='Slowdown flagged as a regression')
+    args = parser.parse_args()
+
+    root = args.data_dir or tempfile.mkdtemp(prefix='annotation-benchmark-')
+    runs = []
+    try:
+        for items in args.items:
+            config = f'{args.rounds}r-{args.groups}g-{args.raters}x-{items}i'
+            directory = os.path.join(root, config)
+            print(f'\n=== {config}: {args.rounds} rounds, {args.groups} groups, {args.raters} raters per group, '
+                  f'{items} items ===')
+
+            if not os.path.isdir(directory):
+                start = time.perf_counter()
+                generate_annotations(directory, args.rounds, args.groups, args.raters, items)
+                print(f'generated in {time.perf_counter() - start:.1f} s')
+
+            runs.append({'config': config, 'results': run_benchmark(directory, args.rounds, args.groups,
+                                                                    args.raters, items, args.repeat)})
+    finally:
+        if args.data_dir is None:
+            shutil.rmtree(root, ignore_errors=True)
+
+    # ru_maxrss is in KB on Linux
+    print(f'\npeak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10:.0f} MB')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(runs, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(runs, json.load(f), args.tolerance):
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+"""
+Checks the vectorized agreement metrics of data_utils against reference implementations
+
+pairwise_kappa and table_kappa are compared with sklearn's cohen_kappa_score(weights='linear') on the items
+both raters annotated, bootstrap_kappa with a plain bootstrap that resamples items and calls
+cohen_kappa_score on each resample, fleiss_kappa with statsmodels' fleiss_kappa and krippendorff_alpha with
+krippendorff.alpha(level_of_measurement='ordinal') on the raw ratings, missing ones as NaN.
+Every check runs on random ratings (with and without missing ratings, including raters who always give the
+same label) and, when the annotations tree is there, on the real annotations. compute_metrics is also run on
+trees without any pair to compare (a round whose groups have one rater each, an empty tree).
+Most of the minute or so it takes goes into the reference bootstrap.
+The references need scikit-learn, statsmodels and krippendorff, which the dashboard itself doesn't import.
+
+Usage:
+    python check_metrics.py [--cases 20] [--seed 0] [--synthetic-only]
+Exits with status 1 if any check fails.
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import warnings
+
+import krippendorff
+import numpy as np
+from sklearn.metrics import cohen_kappa_score
+from statsmodels.stats import inter_rater
+
+import data_utils
+from data_utils import LABELS, MISSING
+
+# Largest difference allowed between a metric and its reference
+TOLERANCE = 1e-9
+# bootstrap_kappa and the reference draw different resamples, so their interval bounds only agree this closely
+BOOTSTRAP_TOLERANCE = 0.05
+BOOTSTRAP_REFERENCE_SAMPLES = 1000
+
+
+def random_scores(rng, raters, items, missing_rate):
+    """
+    Returns (rater, item) scores like one category of a round: an item's raters mostly agree, missing_rate of
+    the ratings are MISSING, and the last rater always gives the same label
+    """
+    truth = rng.integers(LABELS[0], LABELS[-1] + 1, size=items)
+    scores = np.clip(truth + rng.choice([-2, -1, 0, 0, 0, 1, 2], size=(raters, items)), LABELS[0], LABELS[-1])
+    scores[-1] = LABELS[rng.integers(len(LABELS))]
+    scores[rng.random(scores.shape) < missing_rate] = MISSING
+    return scores.astype(np.int8)
+
+
+def synthetic_cases(rng, n_cases):
+    # (name, (rater, item) scores) of every random case
+    for case in range(n_cases):
+        raters, items = int(rng.integers(2, 9)), int(rng.integers(1, 60))
+        missing_rate = [0, 0.1, 0.4][case % 3]
+        yield f'random #{case} ({raters} raters, {items} items, {missing_rate:.0%} missing)', \
+            random_scores(rng, raters, items, missing_rate)
+
+
+def annotation_cases():
+    # (name, (rater, item) scores) of every round and category of the annotations tree
+    with contextlib.redirect_stdout(io.StringIO()):
+        scores, meta = data_utils.read_data(as_tensor=True)
+    for round_idx, ROUND_NUMBER in enumerate(meta.rounds):
+        for category_idx, category in enumerate(data_utils.ANNOTATION_CATEGORIES):
+            yield f'round {ROUND_NUMBER} {category}', \
+                scores[round_idx, :meta.n_raters[round_idx], category_idx, :meta.n_items[round_idx]]
+
+
+def reference_kappa(first, second):
+    # cohen_kappa_score on the items both raters annotated, NaN where it's undefined
+    both = (first != MISSING) & (second != MISSING)
+    if not both.any():
+        return np.nan
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')  # Both raters always gave the same label
+        return cohen_kappa_score(first[both], second[both], weights='linear', labels=LABELS)
+
+
+def contingency_table(first, second):
+    # (5, 5) counts of the label pairs of the items both raters annotated
+    both = (first != MISSING) & (second != MISSING)
+    table = np.zeros((len(LABELS), len(LABELS)), dtype=np.int64)
+    np.add.at(table, (first[both] - LABELS[0], second[both] - LABELS[0]), 1)
+    return table
+
+
+def difference(value, reference):
+    # Absolute difference, 0 when both are NaN and inf when only one is
+    if np.isnan(value) and np.isnan(reference):
+        return 0.0
+    if np.isnan(value) or np.isnan(reference):
+        return np.inf
+    return abs(value - reference)
+
+
+def check_pairwise_kappa(scores):
+    # Largest difference between pairwise_kappa and cohen_kappa_score over every pair of raters
+    kappa = data_utils.pairwise_kappa(scores)
+    return max((difference(kappa[a, b], reference_kappa(scores[a], scores[b]))
+                for a in range(len(scores)) for b in range(len(scores)) if a != b), default=0.0)
+
+
+def check_table_kappa(scores):
+    # Largest difference between table_kappa of the contingency tables and cohen_kappa_score, over every pair
+    pairs = [(a, b) for a in range(len(scores)) for b in range(a + 1, len(scores))]
+    tables = np.array([contingency_table(scores[a], scores[b]) for a, b in pairs])
+    tables = tables.reshape(-1, len(LABELS), len(LABELS))
+    kappa = data_utils.table_kappa(tables)
+    return max((difference(kappa[idx], reference_kappa(scores[a], scores[b])) for idx, (a, b) in enumerate(pairs)),
+               default=0.0)
+
+
+def reference_bootstrap(first, second, rng, n_samples=BOOTSTRAP_REFERENCE_SAMPLES,
+                        confidence=data_utils.BOOTSTRAP_CONFIDENCE):
+    # Percentile bootstrap interval, resampling the items both raters annotated
+    both = np.flatnonzero((first != MISSING) & (second != MISSING))
+    samples = [reference_kappa(first[resampled], second[resampled])
+               for resampled in rng.choice(both, size=(n_samples, len(both)))]
+    alpha = (1 - confidence) / 2
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanquantile(samples, [alpha, 1 - alpha])
+
+
+def check_bootstrap_kappa(scores, rng):
+    """
+    Largest difference between the bootstrap_kappa interval of the first two raters and the reference one.
+    Also checks that a table's interval is the same whether it's computed alone or with others
+    """
+    tables = np.array([contingency_table(scores[0], scores[1]), contingency_table(scores[1], scores[0])])
+    if tables[0].sum() < 10:
+        return 0.0  # Too few items for the two bootstraps to agree
+
+    low, high = data_utils.bootstrap_kappa(tables, keys=[[0], [1]])
+    alone = data_utils.bootstrap_kappa(tables[:1], keys=[[0]])
+    if (low[0], high[0]) != (alone[0][0], alone[1][0]):
+        return np.inf
+
+    reference_low, reference_high = reference_bootstrap(scores[0], scores[1], rng)
+    return max(difference(low[0], reference_low), difference(high[0], reference_high))
+
+
+def check_fleiss_kappa(scores):
+    """
+    Difference between fleiss_kappa and statsmodels' fleiss_kappa. statsmodels expects every item to have the
+    same number of ratings, so both get the items with the most common number of ratings (at least two). Items
+    with fewer than two ratings, which fleiss_kappa should leave out, are passed to fleiss_kappa as well
+    """
+    counts = data_utils.item_label_counts(scores)
+    raters = counts.sum(axis=-1)
+    if not (raters >= 2).any():
+        return difference(data_utils.fleiss_kappa(counts), np.nan)
+
+    values, occurrences = np.unique(raters[raters >= 2], return_counts=True)
+    same = raters == values[occurrences.argmax()]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        reference = inter_rater.fleiss_kappa(counts[same], method='fleiss')
+    return difference(data_utils.fleiss_kappa(counts[same | (raters < 2)]), reference)
+
+
+def check_krippendorff_alpha(scores):
+    # Difference between krippendorff_alpha and krippendorff.alpha on the raw ratings
+    ratings = np.where(scores == MISSING, np.nan, scores.astype(np.float64))
+    if (~np.isnan(ratings)).sum(axis=0).max(initial=0) < 2:
+        reference = np.nan  # Nothing pairable, which krippendorff.alpha rejects
+    else:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            reference = krippendorff.alpha(reliability_data=ratings, level_of_measurement='ordinal',
+                                           value_domain=LABELS)
+    return difference(data_utils.krippendorff_alpha(data_utils.item_label_counts(scores)), reference)
+
+
+def tree_cases(rng):
+    """
+    (name, raters) of trees in which some or every round has no group with two raters, raters as build_tensor
+    takes them: a new round whose first workbook just came in, or no workbooks at all
+    """
+    def rater(ROUND_NUMBER, GROUP_NO, name):
+        scores = random_scores(rng, len(data_utils.ANNOTATION_CATEGORIES), 20, 0.1)
+        return ROUND_NUMBER, GROUP_NO, name, dict(zip(data_utils.ANNOTATION_CATEGORIES, scores))
+
+    yield 'round with one rater', [rater(7, 1, 'A')]
+    yield 'round with one rater per group', [rater(7, 1, 'A'), rater(7, 2, 'B')]
+    yield 'round with one rater after a full round', [rater(6, 1, 'A'), rater(6, 1, 'B'), rater(7, 1, 'A')]
+    yield 'empty tree', []
+
+
+def check_compute_metrics(raters):
+    # Runs compute_metrics on the tree, returns what went wrong (None when nothing did)
+    rounds = sorted({rater[0] for rater in raters})
+    with contextlib.redirect_stdout(io.StringIO()):
+        try:
+            data = data_utils.compute_metrics(*data_utils.build_tensor(rounds, raters))
+        except Exception as error:
+            return f'{type(error).__name__}: {error}'
+
+    # Only rounds with a pair get kappa rows
+    paired = {ROUND_NUMBER for ROUND_NUMBER, GROUP_NO, _, _ in raters
+              if sum(rater[:2] == (ROUND_NUMBER, GROUP_NO) for rater in raters) >= 2}
+    if set(data.kappa['round']) != paired:
+        return f'kappa rows for rounds {sorted(set(data.kappa["round"]))}, expected {sorted(paired)}'
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the agreement metrics against reference implementations')
+    parser.add_argument('--cases', type=int, default=20, help='Random cases to check')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the random cases')
+    parser.add_argument('--synthetic-only', action='store_true', help="Don't check the annotations tree")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    cases = list(synthetic_cases(rng, args.cases))
+    if not args.synthetic_only and os.path.isdir(data_utils.ANNOTATIONS_DIR):
+        cases += list(annotation_cases())
+
+    checks = [
+        ('pairwise_kappa', check_pairwise_kappa, TOLERANCE),
+        ('table_kappa', check_table_kappa, TOLERANCE),
+        ('bootstrap_kappa', lambda scores: check_bootstrap_kappa(scores, rng), BOOTSTRAP_TOLERANCE),
+        ('fleiss_kappa', check_fleiss_kappa, TOLERANCE),
+        ('krippendorff_alpha', check_krippendorff_alpha, TOLERANCE),
+    ]
+
+    failed = 0
+    for check_name, check, tolerance in checks:
+        worst = max((check(scores), name) for name, scores in cases)
+        status = 'ok' if worst[0] <= tolerance else 'FAILED'
+        failed += status != 'ok'
+        print(f'{check_name:<20} {status:<7} largest difference {worst[0]:.2e} ({worst[1]})')
+
+    errors = [(name, error) for name, raters in tree_cases(rng) for error in [check_compute_metrics(raters)] if error]
+    failed += bool(errors)
+    print(f'{"compute_metrics":<20} {"FAILED" if errors else "ok":<7} '
+          + ('; '.join(f'{name}: {error}' for name, error in errors) or 'trees without pairs'))
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,12 @@
+import json
+
+import numpy as np
 from plotly import graph_objects as go, express as px
 from plotly.subplots import make_subplots
 
+from data_utils import MISSING, index_metrics, metric_rows, row_positions
+from metrics_utils import timed
+
 ANNOTATION_CATEGORIES = ['Appropriateness', 'Information content of outputs', 'Humanlikeness']
 linechart_colors = [
 
@@ -14,18 +20,97 @@ linechart_styles = {
     'Information content of outputs': {'dash': 'solid', 'marker': 'square'},
     'Humanlikeness': {'dash': 'solid', 'marker': 'star'},
 }
+# Kappa heatmaps of rounds with more raters than this show one cell per pair of groups instead of per pair of raters
+HEATMAP_RATER_LIMIT = 40
+# Heatmap cells only get a text label up to this many rows / columns
+HEATMAP_LABEL_LIMIT = 25
+# Annotator trajectories draw one line per annotator up to this many annotators, and one shared grey line above
+TRAJECTORY_LINE_LIMIT = 25
+# Decimals kept of the agreement scores sent to the browser
+FIGURE_DECIMALS = 3
+# Columns of the most contentious items table, see top_items
+ITEM_TABLE_COLUMNS = [
+    {'id': 'round', 'name': 'Round'},
+    {'id': 'group', 'name': 'Group'},
+    {'id': 'item', 'name': 'Item'},
+    {'id': 'raters', 'name': 'Raters'},
+    {'id': 'mean', 'name': 'Mean score'},
+    {'id': 'spread', 'name': 'Spread'},
+    {'id': 'mean_difference', 'name': 'Mean difference'},
+    {'id': 'lowest', 'name': 'Lowest'},
+    {'id': 'highest', 'name': 'Highest'},
+    {'id': 'ratings', 'name': 'Ratings'},
+    {'id': 'model', 'name': 'Model'},
+    {'id': 'prompt', 'name': 'Prompt'},
+    {'id': 'response', 'name': 'Response'},
+]
+# Most items the table lists at once
+ITEM_LIMIT = 100
+
 
+def compact_array(values, decimals=FIGURE_DECIMALS):
+    """
+    Returns values in the smallest dtype that holds them, which plotly sends as a short base64 typed array:
+    whole numbers as the smallest integer type, anything else rounded to decimals as float32
+    """
+    values = np.asarray(values)
+    if values.dtype.kind in 'iu':
+        if values.size == 0:
+            return values.astype(np.int32)
+        return values.astype(np.result_type(np.min_scalar_type(values.min()), np.min_scalar_type(values.max())))
+    return np.round(values.astype(np.float64), decimals).astype(np.float32)
 
-def create_linechart(df):
+
+def _compact_columns(df, columns):
+    # The numeric columns a plotly express figure reads, as compact arrays
+    return df.assign(**{column: compact_array(df[column].to_numpy()) for column in columns})
+
+
+def create_placeholder_figure(text='Loading data...'):
+    # Empty figure shown while the data is still loading
     fig = go.Figure()
-    for group_no in range(1, 5):
+    fig.update_layout(
+        xaxis={'visible': False},
+        yaxis={'visible': False},
+        annotations=[
+            go.layout.Annotation(
+                text=text,
+                showarrow=False,
+                font=dict(
+                    size=16
+                ),
+                xref="paper",
+                yref="paper",
+            )
+        ]
+    )
+    return fig
+
+
+@timed('create_linechart')
+def create_linechart(df, positions=None):
+    # positions: the kappa field of a MetricIndex, rows by (category, group)
+    if positions is None:
+        positions = row_positions(df, ['category', 'group'])
+
+    fig = go.Figure()
+    for group_idx, group_no in enumerate(sorted({key[1] for key in positions})):
         for category in ANNOTATION_CATEGORIES:
+            rows = metric_rows(df, positions, category, group_no)
             fig.add_trace(go.Scatter(
-                x=df[df['group'] == group_no][df['category'] == category]['round'],
-                y=df[df['group'] == group_no][df['category'] == category]['kappa_score'],
+                x=compact_array(rows['round']),
+                y=compact_array(rows['kappa_score']),
+                # Bootstrap confidence interval
+                error_y=dict(
+                    type='data',
+                    symmetric=False,
+                    array=compact_array(rows['kappa_high'] - rows['kappa_score']),
+                    arrayminus=compact_array(rows['kappa_score'] - rows['kappa_low']),
+                    thickness=1,
+                ),
                 name=f"Group {group_no} - {category}",
                 line=dict(
-                    color=linechart_colors[group_no - 1],
+                    color=linechart_colors[group_idx % len(linechart_colors)],
                     width=2,
                     dash=linechart_styles[category]['dash'],
                 ),
@@ -36,16 +121,102 @@ def create_linechart(df):
 
                 )
             ))
-            fig.update_xaxes(type='category')  # Make x axis discrete
-            fig.update_layout(title="Cohen's Kappa per Round",
-                              xaxis_title='Round',
-                              yaxis_title="Cohen's Kappa")
+    fig.update_xaxes(type='category')  # Make x axis discrete
+    fig.update_layout(title="Cohen's Kappa per Round",
+                      xaxis_title='Round',
+                      yaxis_title="Cohen's Kappa")
+    return fig
+
+
+@timed('create_multi_rater_linechart')
+def create_multi_rater_linechart(df, positions=None):
+    # Agreement between everyone in a round: Fleiss' kappa (solid) and Krippendorff's alpha (dashed)
+    if positions is None:
+        positions = row_positions(df, ['category'])
+
+    fig = go.Figure()
+    for idx, category in enumerate(ANNOTATION_CATEGORIES):
+        rows = metric_rows(df, positions, category)
+        for column, name, dash in [('fleiss_kappa', "Fleiss' Kappa", 'solid'),
+                                   ('krippendorff_alpha', "Krippendorff's Alpha", 'dash')]:
+            fig.add_trace(go.Scatter(
+                x=compact_array(rows['round']),
+                y=compact_array(rows[column]),
+                name=f"{name} - {category}",
+                line=dict(
+                    color=linechart_colors[idx],
+                    width=2,
+                    dash=dash,
+                ),
+                mode='lines+markers',
+                marker=dict(
+                    symbol=linechart_styles[category]['marker'],
+                    size=12
+                )
+            ))
+    fig.update_xaxes(type='category')  # Make x axis discrete
+    fig.update_layout(title="Multi-rater Agreement per Round (all annotators)",
+                      xaxis_title='Round',
+                      yaxis_title="Agreement")
+    return fig
+
+
+@timed('create_annotator_trajectories')
+def create_annotator_trajectories(df, category, positions=None):
+    # Every annotator's agreement with their partners, with the round consensus, and its drift, round by round.
+    # positions: the annotators field of a MetricIndex, rows by (category, annotator)
+    if positions is None:
+        positions = row_positions(df, ['category', 'annotator'])
+
+    metrics = [('partner_kappa', 'Kappa with partners'), ('consensus_kappa', 'Kappa with the round consensus'),
+               ('drift', 'Drift from earlier rounds')]
+    annotators = sorted(key[1] for key in positions if key[0] == category)
+    fig = make_subplots(rows=len(metrics), cols=1, shared_xaxes=True, vertical_spacing=0.06,
+                        subplot_titles=[title for _, title in metrics])
+
+    if len(annotators) <= TRAJECTORY_LINE_LIMIT:
+        for idx, annotator in enumerate(annotators):
+            rows = metric_rows(df, positions, category, annotator)
+            color = px.colors.qualitative.Plotly[idx % len(px.colors.qualitative.Plotly)]
+            for row, (column, _) in enumerate(metrics):
+                fig.add_trace(go.Scatter(
+                    x=compact_array(rows['round']),
+                    y=compact_array(rows[column]),
+                    name=rows['name'].iloc[-1],  # The [Name] of their latest round, see data_utils._annotator_drift
+                    legendgroup=annotator,
+                    showlegend=row == 0,
+                    line=dict(color=color, width=2),
+                    mode='lines+markers',
+                ), row + 1, 1)
+    else:
+        # One trace per metric, annotators separated by gaps, so the figure doesn't grow a trace per annotator
+        rows = df.take(np.concatenate([positions[(category, annotator)] for annotator in annotators]))
+        gaps = np.flatnonzero(rows['annotator'].to_numpy()[1:] != rows['annotator'].to_numpy()[:-1]) + 1
+        for row, (column, title) in enumerate(metrics):
+            fig.add_trace(go.Scatter(
+                x=compact_array(np.insert(rows['round'].to_numpy(dtype=np.float64), gaps, np.nan)),
+                y=compact_array(np.insert(rows[column].to_numpy(dtype=np.float64), gaps, np.nan)),
+                text=np.insert(rows['name'].to_numpy(dtype=object), gaps, ''),
+                hovertemplate='%{text}: %{y}<extra></extra>',
+                name=title,
+                showlegend=False,
+                line=dict(color='rgba(100, 100, 100, 0.3)', width=1),
+                mode='lines',
+            ), row + 1, 1)
+
+    fig.update_xaxes(dtick=1, title_text='Round', row=len(metrics), col=1)  # One tick per round
+    fig.update_layout(title=f"Annotator Consistency across Rounds - {category}", height=800)
     return fig
 
 
-def create_histograms_differences(df, category):
+@timed('create_histograms_differences')
+def create_histograms_differences(df, category, positions=None):
+    # positions: the differences field of a MetricIndex, rows by category
+    if positions is None:
+        positions = row_positions(df, ['category'])
+
     fig = px.histogram(
-        df[df['category'] == category],
+        _compact_columns(metric_rows(df, positions, category), ['round', 'value']),
         x='round',
         y='value',
         color='difference',
@@ -82,11 +253,16 @@ def create_histograms_differences(df, category):
     return fig
 
 
-def create_histograms_annotations(df, category):
+@timed('create_histograms_annotations')
+def create_histograms_annotations(df, category, positions=None):
+    # positions: the annotations field of a MetricIndex, rows by category
+    if positions is None:
+        positions = row_positions(df, ['category'])
+
     fig = px.histogram(
-        df[df['category'] == category],
+        _compact_columns(metric_rows(df, positions, category), ['round', 'count']),
         x='round',
-        y='annotation',
+        y='count',  # Rows are already counted, so the bars add them up
         color='annotation',
         barmode='group',
         facet_row='group',
@@ -118,38 +294,82 @@ def create_histograms_annotations(df, category):
     return fig
 
 
-def create_heatmap_kappa(data, category):
+def aggregate_group_kappa(matrix, groups):
+    """
+    Averages a round's rater-by-rater kappa matrix over every pair of groups, within each group on the diagonal.
+    Returns (group numbers, (group, group) matrix), with NaN below the diagonal like the rater matrix
+    """
+    matrix = np.asarray(matrix, dtype=np.float64)
+    # Pairs are only filled in above the diagonal, mirror them so every block holds all of its pairs
+    symmetric = np.where(np.isnan(matrix), matrix.T, matrix)
+    scored = ~np.isnan(symmetric)
+
+    group_numbers, group_idx = np.unique(groups, return_inverse=True)
+    membership = np.eye(len(group_numbers))[group_idx]  # (rater, group)
+    sums = membership.T @ np.where(scored, symmetric, 0) @ membership
+    counts = membership.T @ scored @ membership
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts
+    means[np.tril_indices(len(group_numbers), -1)] = np.nan
+
+    return group_numbers, means
+
+
+def _round_raters(raters, round, positions=None):
+    # Raters of a round, in rater order. positions: the raters field of a MetricIndex
+    if positions is None:
+        positions = row_positions(raters, ['round'])
+    return metric_rows(raters, positions, round).sort_values('rater')
+
+
+def _kappa_heatmap_trace(matrix, labels):
+    # z goes out once, as a rounded float32 typed array, and cell labels are formatted from it in the browser
+    return go.Heatmap(
+        x=labels,
+        y=labels,
+        z=compact_array(matrix),
+        type='heatmap',
+        hoverongaps=False,
+        coloraxis='coloraxis',
+        texttemplate="%{z:.2f}" if len(labels) <= HEATMAP_LABEL_LIMIT else None,
+        textfont={"size": 10}
+    )
+
+
+@timed('create_heatmap_kappa')
+def create_heatmap_kappa(data, category, raters=None, raters_positions=None):
+    """
+    One rater-by-rater kappa heatmap per round. With the raters frame, rounds with more than HEATMAP_RATER_LIMIT
+    raters show the mean kappa of every pair of groups instead (see create_group_heatmap to drill into them)
+    """
     fig = make_subplots(
         1,
-        6,
-        # len(data.keys()),
+        max(len(data), 1),
         vertical_spacing=0.05,
-        horizontal_spacing=0.05,
+        # make_subplots needs the spacing to fit between the columns
+        horizontal_spacing=min(0.05, 0.5 / max(len(data) - 1, 1)),
         # shared_yaxes=True,
-        # subplot_titles=[f"Round {i}" for i in data.keys()]
-        subplot_titles=[f"Round 1", "Round 2", "Round 3", "Round 4", "Round 5", "Round 6"]
+        subplot_titles=[f"Round {i}" for i in data.keys()]
     )
 
+    if raters is not None and raters_positions is None:
+        raters_positions = row_positions(raters, ['round'])
+
     # Patches to add emphasis on groups
 
     for idx, round in enumerate(data.keys()):
-        # if round > 3:
-        #     break
         round_data = data[round][category]
 
-        fig.add_trace(
-            go.Heatmap(
-                x=[f"Rater {group_no + 1}" for group_no in range(len(round_data))],
-                y=[f"Rater {group_no + 1}" for group_no in range(len(round_data))],
-                z=round_data,
-                type='heatmap',
-                hoverongaps=False,
-                coloraxis='coloraxis',
-                text=round_data,
-                texttemplate="%{text:.2f}",
-                textfont={"size": 10}
-            ), 1, idx + 1
-        )
+        if raters is not None and len(round_data) > HEATMAP_RATER_LIMIT:
+            round_groups = _round_raters(raters, round, raters_positions)['group'].to_numpy()
+            group_numbers, round_data = aggregate_group_kappa(round_data, round_groups)
+            labels = [f"Group {group_no}" for group_no in group_numbers]
+        else:
+            labels = [f"Rater {group_no + 1}" for group_no in range(len(round_data))]
+
+        fig.add_trace(_kappa_heatmap_trace(round_data, labels), 1, idx + 1)
+        fig.update_xaxes(showticklabels=len(labels) <= HEATMAP_LABEL_LIMIT, row=1, col=idx + 1)
+        fig.update_yaxes(showticklabels=len(labels) <= HEATMAP_LABEL_LIMIT, row=1, col=idx + 1)
 
     fig.update_layout(
         coloraxis={'colorscale': 'PuBu'},
@@ -158,49 +378,150 @@ def create_heatmap_kappa(data, category):
     return fig
 
 
-def create_contingency_heatmap(data, kappa_data, category):
+def heatmap_drill_in_target(data, raters, point):
+    """
+    Returns the (round, groups) behind a clicked point of create_heatmap_kappa: the groups of the clicked
+    row and column, whether the round showed raters or groups
+    """
+    round = list(data.keys())[point['curveNumber']]
+    round_groups = _round_raters(raters, round)['group'].to_numpy()
 
-    NUM_ROUNDS = 6
+    groups = set()
+    for label in (point['x'], point['y']):
+        kind, number = label.split()
+        groups.add(int(number) if kind == 'Group' else int(round_groups[int(number) - 1]))
+
+    return round, sorted(groups)
+
+
+@timed('create_group_heatmap')
+def create_group_heatmap(data, raters, category, round, groups):
+    # Rater-by-rater kappa of the given groups in one round, labelled with the annotator names
+    round_raters = _round_raters(raters, round)
+    selected = np.flatnonzero(np.isin(round_raters['group'].to_numpy(), groups))
+    matrix = np.asarray(data[round][category])[np.ix_(selected, selected)]
+    labels = [f"{name} (G{group_no})" for name, group_no in
+              zip(round_raters['name'].to_numpy()[selected], round_raters['group'].to_numpy()[selected])]
+
+    fig = go.Figure(_kappa_heatmap_trace(matrix, labels))
+    fig.update_xaxes(showticklabels=len(labels) <= HEATMAP_LABEL_LIMIT)
+    fig.update_yaxes(showticklabels=len(labels) <= HEATMAP_LABEL_LIMIT)
+    fig.update_layout(
+        coloraxis={'colorscale': 'PuBu'},
+        title=f"Round {round}, {', '.join(f'Group {group_no}' for group_no in groups)} - {category}",
+    )
+
+    return fig
+
+
+def _rounded(value):
+    # top_items takes a round argument, which hides round()
+    return round(float(value), 2)
+
+
+def _item_ratings(data, index, round, scores):
+    # 'Name: score' of every rater behind an item row (a row of item_scores), lowest score first
+    names = data.raters['name'].to_numpy()[index.raters[(round,)]]
+    raters = np.flatnonzero(scores != MISSING)
+    raters = raters[np.argsort(scores[raters], kind='stable')]
+    return ', '.join(f'{names[rater]}: {scores[rater]}' for rater in raters)
+
+
+@timed('top_items')
+def top_items(data, category, round=None, group=0, k=10, index=None):
+    """
+    Returns the k items of a category raters disagreed on most, as records for the ITEM_TABLE_COLUMNS table.
+    round None ranks the items of every round together, and group 0 ranks the disagreement between all raters
+    of the round instead of within one group. Reads the ranked positions of the MetricIndex, so only k rows
+    are ever touched
+    """
+    if index is None:
+        index = index_metrics(data)
+    if round is None:
+        positions = index.items.get((category, group))
+    else:
+        positions = index.item_cells.get((category, round, group))
+    if positions is None:
+        return []
+
+    positions = positions[:min(k, ITEM_LIMIT)]
+    rows = data.items.take(positions)
+    scores = np.asarray(data.item_scores[positions])
+    return [
+        {
+            'round': int(row.round),
+            'group': int(row.group) if row.group else 'All',
+            # Items are counted from 1, like the rows below the header of the workbooks
+            'item': int(row.item) + 1,
+            'raters': int(row.raters),
+            'mean': _rounded(row.mean),
+            'spread': int(row.spread),
+            'mean_difference': _rounded(row.mean_difference),
+            'lowest': row.lowest,
+            'highest': row.highest,
+            'ratings': _item_ratings(data, index, row.round, row_scores),
+            'model': row.model,
+            'prompt': row.prompt,
+            'response': row.response,
+        }
+        for row, row_scores in zip(rows.itertuples(), scores)
+    ]
+
+
+@timed('create_contingency_heatmap')
+def create_contingency_heatmap(data, kappa_data, category, positions=None):
+    # positions: the kappa_cells field of a MetricIndex, rows by (category, round, group)
+    if positions is None:
+        positions = row_positions(kappa_data, ['category', 'round', 'group'])
+
+    # data is a (round, group, category, 5, 5) array, over the same rounds and groups as kappa_data
+    rounds = sorted(kappa_data['round'].unique())
+    groups = sorted(kappa_data['group'].unique())
+    category_idx = ANNOTATION_CATEGORIES.index(category)
+    kappa_score, kappa_low, kappa_high = (kappa_data[column].to_numpy()
+                                          for column in ['kappa_score', 'kappa_low', 'kappa_high'])
 
     subplot_titles = []
     # GROUP FIRST - group = row, round = col
-    for group in range(1, 5):  # 4 groups
-        for round in range(1, NUM_ROUNDS + 1):
-            annotation_score = format(kappa_data[kappa_data['category'] == category][kappa_data['round'] == round][kappa_data['group'] == group]['kappa_score'].iloc[0], ".2f")
-            subplot_titles.append(f"κ: {annotation_score}")
+    for group in groups:
+        for round in rounds:
+            kappa_rows = positions.get((category, round, group))
+            if kappa_rows is None:
+                # The group has no pair of raters in this round
+                subplot_titles.append('')
+                continue
+            row = kappa_rows[0]
+            annotation_score = format(kappa_score[row], ".2f")
+            # Bootstrap confidence interval
+            kappa_interval = f"[{kappa_low[row]:.2f}, {kappa_high[row]:.2f}]"
+            subplot_titles.append(f"κ: {annotation_score} {kappa_interval}")
     fig = make_subplots(
-        rows=4, # Number of groups - rows
-        cols=NUM_ROUNDS,
-        # len(data.keys()), # Number of rounds - cols
-        vertical_spacing=0.1,
-        horizontal_spacing=0.05,
+        rows=max(len(groups), 1),  # Number of groups - rows
+        cols=max(len(rounds), 1),  # Number of rounds - cols
+        # make_subplots needs the spacing to fit between the rows / columns
+        vertical_spacing=min(0.1, 0.5 / max(len(groups) - 1, 1)),
+        horizontal_spacing=min(0.05, 0.5 / max(len(rounds) - 1, 1)),
         subplot_titles=subplot_titles,
     )
 
     # Patches to add emphasis on groups
 
-    for round in data.keys():
-        # if round > NUM_ROUNDS:
-        #     break
-
-        for group in data[round].keys():
+    for round_idx, round in enumerate(rounds):
+        for group_idx, group in enumerate(groups):
 
-            annotation_data = data[round][group][category]
-
-            # for idx, group in enumerate(round_data.keys()):
+            annotation_data = data[round_idx, group_idx, category_idx]
 
             fig.add_trace(
                 go.Heatmap(
                     x=[f"{i}" for i in [1,2,3,4,5]], # The five possible annotation scores
                     y=[f"{i}" for i in [1,2,3,4,5]], # The five possible annotation scores
-                    z=annotation_data,
+                    z=compact_array(annotation_data),
                     type='heatmap',
                     hoverongaps=False,
                     coloraxis='coloraxis',
-                    text=annotation_data,
-                    texttemplate="%{text: d}",
+                    texttemplate="%{z: d}",  # Labels are formatted from z in the browser
                     textfont={"size": 10},
-                ), group, round
+                ), group_idx + 1, round_idx + 1
             )
 
 
@@ -211,15 +532,122 @@ def create_contingency_heatmap(data, kappa_data, category):
     # fig.update_layout(yaxis=dict(scaleanchor='x'))
 
     # Update master x axes
-    for round in range(1, NUM_ROUNDS+1):
-        fig.update_xaxes(title_text=f"Round {round}", row=4, col=round)
+    for round_idx, round in enumerate(rounds):
+        fig.update_xaxes(title_text=f"Round {round}", row=len(groups), col=round_idx + 1)
 
     # Update master y axes
-    for group in range(1, 5): # 4 groups
-        fig.update_yaxes(title_text=f"Group {group}", row=group, col=1)
+    for group_idx, group in enumerate(groups):
+        fig.update_yaxes(title_text=f"Group {group}", row=group_idx + 1, col=1)
 
     fig.update_layout(
         title=f'Contingency Table for {category}'
     )
 
     return fig
+
+
+@timed('figure_json')
+def figure_json(fig):
+    # Serializes a figure to plain JSON (dicts and lists), the form every query_* function serves.
+    # The template only keeps the defaults of the trace types the figure uses (it carries every type otherwise)
+    figure = json.loads(fig.to_json())
+    template_data = figure['layout'].get('template', {}).get('data')
+    if template_data:
+        used = {trace.get('type', 'scatter') for trace in figure['data']}
+        figure['layout']['template']['data'] = {
+            trace_type: defaults for trace_type, defaults in template_data.items() if trace_type in used
+        }
+    return figure
+
+
+@timed('create_category_figures')
+def create_category_figures(data, index=None):
+    """
+    Builds the figures that depend on the category dropdown, for every category.
+    Returns {category: (differences, annotations, heatmap, contingency, trajectories)}, with each figure already
+    serialized to plain JSON, so serving one is a dictionary lookup
+    """
+    difference_df, kappa_df, annotation_df, group_kappa_data, contingency_table = data[:5]
+    if index is None:
+        index = index_metrics(data)
+
+    figures = {}
+    for category in ANNOTATION_CATEGORIES:
+        figures[category] = tuple(figure_json(fig) for fig in (
+            create_histograms_differences(difference_df, category, index.differences),
+            create_histograms_annotations(annotation_df, category, index.annotations),
+            create_heatmap_kappa(group_kappa_data, category, data.raters, index.raters),
+            create_contingency_heatmap(contingency_table, kappa_df, category, index.kappa_cells),
+            create_annotator_trajectories(data.annotators, category, index.annotators),
+        ))
+
+    return figures
+
+
+@timed('create_dashboard_figures')
+def create_dashboard_figures(data, index=None):
+    """
+    Builds every figure of the dashboard from a DashboardData, as plain JSON:
+    {'figures': create_category_figures output, 'linechart': kappa linechart,
+     'multi_rater': multi-rater linechart, 'payload': create_figure_payload output}
+    """
+    if index is None:
+        index = index_metrics(data)
+    figures = create_category_figures(data, index)
+
+    return {
+        'figures': figures,
+        'linechart': figure_json(create_linechart(data.kappa, index.kappa)),
+        'multi_rater': figure_json(create_multi_rater_linechart(data.multi_rater, index.multi_rater)),
+        'payload': create_figure_payload(figures),
+    }
+
+
+@timed('create_figure_payload')
+def create_figure_payload(figures):
+    """
+    Packs the output of create_category_figures into one compact payload for switching categories in the browser.
+    Everything the categories share is sent once in 'base', and each category only sends what differs:
+    {'base': [{'data': [...], 'layout': {...}}, ...],
+     'patches': {category: [{'data': [...], 'layout': {...}, 'merge': bool}, ...]}}
+    With merge, each patch trace is merged into the matching base trace, otherwise it replaces the base traces
+    (when the categories don't have the same number of traces)
+    """
+    categories = list(figures.keys())
+    payload = {'base': [], 'patches': {category: [] for category in categories}}
+
+    for fig_idx in range(len(figures[categories[0]])):
+        versions = [figures[category][fig_idx] for category in categories]
+        first = versions[0]
+
+        shared_layout = {
+            key: value for key, value in first['layout'].items()
+            if all(key in version['layout'] and version['layout'][key] == value for version in versions)
+        }
+
+        merge = all(len(version['data']) == len(first['data']) for version in versions)
+        shared_data = []
+        if merge:
+            for trace_idx, trace in enumerate(first['data']):
+                shared_data.append({
+                    key: value for key, value in trace.items()
+                    if all(key in version['data'][trace_idx] and version['data'][trace_idx][key] == value
+                           for version in versions)
+                })
+
+        payload['base'].append({'data': shared_data, 'layout': shared_layout})
+
+        for category, version in zip(categories, versions):
+            if merge:
+                data = [{key: value for key, value in trace.items() if key not in shared_data[trace_idx]}
+                        for trace_idx, trace in enumerate(version['data'])]
+            else:
+                data = version['data']
+
+            payload['patches'][category].append({
+                'data': data,
+                'layout': {key: value for key, value in version['layout'].items() if key not in shared_layout},
+                'merge': merge,
+            })
+
+    return payload
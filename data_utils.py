@@ -5,23 +5,46 @@
 """
 
 import numpy as np
-import glob
+import openpyxl
+import hashlib
+import json
 import pandas as pd
 import os
-from sklearn.metrics import cohen_kappa_score
+import tempfile
+import threading
+import warnings
+from concurrent.futures import ProcessPoolExecutor
 import itertools
+import multiprocessing
+import re
+from collections import namedtuple
+from dataclasses import dataclass
+
+from metrics_utils import count, timed
 
 # File path to annotations folder
 
-BASE_PATH = './annotations/round'
-ROUNDS = 6
-# NUMBER_OF_GROUPS = 4
+ANNOTATIONS_DIR = './annotations'
+# Names annotators signed some rounds with, mapped to the name they are known by, see annotator_aliases
+ANNOTATOR_ALIASES_FILE = './annotator_aliases.json'
+# Round 0 was the annotation test run
+EXCLUDED_ROUNDS = {0}
+# Parsed annotation columns are cached here, see read_annotations
+CACHE_DIR = './.annotation_cache'
+# Number of processes used to parse workbooks in read_data, 1 parses them serially
+INGEST_WORKERS = int(os.environ.get('INGEST_WORKERS', 1))
 
 ANNOTATION_CATEGORIES = ['Appropriateness', 'Information content of outputs', 'Humanlikeness']
+# Columns describing each item (the same in every workbook of a round), shown next to its disagreement
+ITEM_COLUMNS = ['prompt', 'response', 'model']
+# All possible annotation labels
+LABELS = [1, 2, 3, 4, 5]
+# Marks a missing annotation in the rater tensor
+MISSING = -1
 # Possible Cohen's Kappa Calculation Combos:
 # 1. Same round, within group (in two's)
 # 2. Same round, everyone
-# 2. Different rounds, same person (see how much the agreement changes)
+# 2. Different rounds, same person (see how much the agreement changes) - see _annotator_frame
 # 2. Same round, across groups (average groups - calculate kappa across groups)
 
 """
@@ -31,336 +54,1202 @@ Calculates the differences in annotations for each group per round and returns i
 
 # Reads annotation data and returns a 3D matrix
 # Round - Group - Category - annotations
-def read_data():
+# With workers > 1, workbooks are parsed in a process pool (one task per xlsx file)
+# With as_tensor=True, returns a (scores, meta) pair instead, see build_tensor
+def read_data(use_cache=True, workers=INGEST_WORKERS, as_tensor=False):
     # For each group, calculate their cohen's kappa
     # for group_no in range(1, NUMBER_OF_GROUPS+1):
 
-    rounds = {}
     print('attempting to calculate differences')
     print(os.getcwd())
-    for ROUND_NUMBER in range(1, ROUNDS + 1):
-        groups = {}
-        for GROUP_NO in range(1, 6):
-            categories = {}
 
-            # Build final path to dataset
-            FINAL_PATH = BASE_PATH + str(ROUND_NUMBER) + '/group' + str(GROUP_NO) + '/'
+    # First pass: list every workbook
+    catalog = annotation_catalog()
+    rounds = sorted({entry.round for entry in catalog})
+
+    # Second pass: parse each workbook once (results come back in catalog order)
+    annotator_dfs = load_workbooks(catalog, use_cache, workers)
+
+    if as_tensor:
+        return build_tensor(
+            rounds,
+            [(entry.round, entry.group, entry.name, annotator_df)
+             for entry, annotator_df in zip(catalog, annotator_dfs)]
+        )
+
+    # Finally, split each workbook up per category
+    rounds = {ROUND_NUMBER: {} for ROUND_NUMBER in rounds}
+    for entry, annotator_df in zip(catalog, annotator_dfs):
+        groups = rounds[entry.round]
+        if entry.group not in groups:
+            groups[entry.group] = {annotation_category: [] for annotation_category in ANNOTATION_CATEGORIES}
+
+        # For each annotation category, compile annotations
+        for annotation_category in ANNOTATION_CATEGORIES:
+            groups[entry.group][annotation_category].append(annotator_df[annotation_category])
+
+    return rounds
+
 
-            # Use glob to grab all .xlsx files
-            xlsx_files = glob.glob(FINAL_PATH + '*.xlsx')
+"""
+Catalog of the annotations tree.
 
-            # Skip if files don't exist
-            if len(xlsx_files) == 0:
+One pass over ANNOTATIONS_DIR lists every roundN/groupG/[Name]*.xlsx workbook with its annotator name and
+fingerprint (mtime, size), and every loader works off that list. Directory listings are reused until the
+directory's mtime changes, so refreshing the catalog costs one stat per directory and workbook. Workbooks aren't
+opened here: read_xlsx_columns finds where the data ends while it reads the columns it needs.
+"""
+
+# Entries start like the old (round, group, path) task tuples
+CatalogEntry = namedtuple('CatalogEntry', ['round', 'group', 'path', 'name', 'mtime_ns', 'size'])
+
+ROUND_DIR = re.compile(r'round(\d+)$')
+GROUP_DIR = re.compile(r'group(\d+)$')
+
+_catalog_lock = threading.Lock()
+_listings = {}  # directory -> (mtime, [(name, is directory)])
+
+
+def _list_directory(directory):
+    mtime_ns = os.stat(directory).st_mtime_ns
+    cached = _listings.get(directory)
+    if cached is None or cached[0] != mtime_ns:
+        with os.scandir(directory) as entries:
+            cached = (mtime_ns, sorted((entry.name, entry.is_dir()) for entry in entries))
+        _listings[directory] = cached
+    return cached[1]
+
+
+def _numbered_directories(directory, pattern):
+    # (number, path) of every sub directory matching pattern, in numeric order
+    numbered = []
+    for name, is_dir in _list_directory(directory):
+        match = pattern.match(name)
+        if is_dir and match:
+            numbered.append((int(match.group(1)), os.path.join(directory, name)))
+    return sorted(numbered)
+
+
+@timed('annotation_catalog')
+def annotation_catalog():
+    """
+    Returns a CatalogEntry for every workbook in the annotations tree, in a deterministic round - group - file order
+    """
+    with _catalog_lock:
+        found = []
+        for ROUND_NUMBER, round_dir in _numbered_directories(ANNOTATIONS_DIR, ROUND_DIR):
+            if ROUND_NUMBER in EXCLUDED_ROUNDS:
                 continue
+            for GROUP_NO, group_dir in _numbered_directories(round_dir, GROUP_DIR):
+                for name, is_dir in _list_directory(group_dir):
+                    if is_dir or name.startswith('.') or not name.endswith('.xlsx'):
+                        continue
+                    path = os.path.join(group_dir, name)
+                    stat = os.stat(path)
+                    found.append(CatalogEntry(ROUND_NUMBER, GROUP_NO, path, annotator_name(path), stat.st_mtime_ns,
+                                              stat.st_size))
+
+        return found
+
+
+@timed('load_workbooks')
+def load_workbooks(catalog, use_cache=True, workers=INGEST_WORKERS):
+    # Parses the workbook of every catalog entry, either serially or in a process pool.
+    # The pool starts its processes from a forkserver: load_workbooks runs on the refresh thread of a threaded server,
+    # and a forked child could inherit a lock (metrics_utils._lock, say) that another thread holds at that moment
+    paths = [entry.path for entry in catalog]
+    if workers is not None and workers > 1 and len(catalog) > 1:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('forkserver')) as executor:
+            return list(executor.map(read_annotations, paths, itertools.repeat(None), itertools.repeat(use_cache)))
+
+    return [read_annotations(path, use_cache=use_cache) for path in paths]
+
+
+@timed('read_xlsx_columns')
+def read_xlsx_columns(xlsx_file, columns, nrows=None, numeric=True):
+    """
+    Reads the given columns of the first nrows (default: all) of a workbook's first sheet, like
+    pd.read_excel(xlsx_file)[:nrows][columns], but streamed with openpyxl's read-only mode:
+    only the header row and the needed columns of the first nrows rows are ever turned into values,
+    so long prompt/response columns and rows past nrows cost next to nothing.
+    Trailing rows that are blank in every requested column are dropped, like the blank rows pandas drops.
+    With numeric=False, values are returned as they are stored instead of being converted to numbers
+    """
+    workbook = openpyxl.load_workbook(xlsx_file, read_only=True, data_only=True, keep_links=False)
+    try:
+        sheet = workbook.worksheets[0]
+
+        # Resolve the header row once
+        header = next(sheet.iter_rows(min_row=1, max_row=1, values_only=True), ())
+        positions = {name: idx for idx, name in enumerate(header) if name is not None}
+        missing = [column for column in columns if column not in positions]
+        if missing:
+            raise KeyError(f'{xlsx_file} has no column(s) {missing}')
+
+        column_idx = [positions[column] for column in columns]
+        min_col, max_col = min(column_idx), max(column_idx)
+
+        rows = []
+        max_row = None if nrows is None else nrows + 1
+        for row in sheet.iter_rows(min_row=2, max_row=max_row, min_col=min_col + 1, max_col=max_col + 1,
+                                   values_only=True):
+            rows.append([row[idx - min_col] if idx - min_col < len(row) else None for idx in column_idx])
+    finally:
+        workbook.close()
+
+    # Like pandas, drop trailing blank rows
+    while rows and all(value is None for value in rows[-1]):
+        rows.pop()
+
+    df = pd.DataFrame.from_records(rows, columns=columns)
+    if not numeric:
+        return df
+
+    for column in columns:
+        if df[column].dtype == object:
+            df[column] = pd.to_numeric(df[column], errors='coerce')
+        # Like pandas, whole numbers stored as floats come back as ints
+        values = df[column].to_numpy()
+        if values.dtype.kind == 'f' and len(values) and np.all(np.isfinite(values) & (values == np.round(values))):
+            df[column] = values.astype(np.int64)
+
+    return df
+
+
+def read_item_text(xlsx_file, nrows=None):
+    """
+    Returns the ITEM_COLUMNS of the first nrows (default: all) of a workbook as strings
+    (empty when the workbook doesn't have them)
+    """
+    try:
+        df = read_xlsx_columns(xlsx_file, ITEM_COLUMNS, nrows, numeric=False)
+    except KeyError:
+        df = pd.DataFrame(columns=ITEM_COLUMNS)
+
+    return df.fillna('').astype(str)
+
+
+"""
+On-disk cache of parsed annotation columns.
 
-            # For each annotation category, compile annotations
-            for annotation_category in ANNOTATION_CATEGORIES:
+Every workbook gets one .npz file in CACHE_DIR holding its ANNOTATION_CATEGORIES columns,
+along with the mtime, size and content hash of the xlsx it was parsed from. Unchanged
+workbooks load straight from the .npz; new or edited ones go through openpyxl again.
+"""
 
-                # Read xlsx files into two different Series
-                raters = []
-                difference_count = [0, 0, 0, 0, 0]  # Differences of 0, 1, 2, 3, 4
 
-                for xlsx_annotator in xlsx_files:
-                    if ROUND_NUMBER!=6:
-                        annotator_df = pd.read_excel(xlsx_annotator, engine='openpyxl')[:50]
-                    else:
-                        annotator_df = pd.read_excel(xlsx_annotator, engine='openpyxl')[:400]
-                    
+def _cache_path(xlsx_file, nrows):
+    # One cache entry per (workbook, row limit)
+    key = hashlib.sha1(f'{os.path.abspath(xlsx_file)}:{nrows}'.encode('utf-8')).hexdigest()
+    return os.path.join(CACHE_DIR, key + '.npz')
 
-                    # Convert each column (series) into lists
-                    annotations = annotator_df[annotation_category]
 
-                    raters.append(annotations)
+def _file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
 
-                # Set annotations for this category
-                categories[annotation_category] = raters
 
-            # Set category values for this group
-            groups[GROUP_NO] = categories
+def _write_cache(cache_file, columns, stat, digest):
+    os.makedirs(CACHE_DIR, exist_ok=True)
 
-        # Set group number for this round
-        rounds[ROUND_NUMBER] = groups
+    # Write to a temp file first so readers never see a half-written entry
+    fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix='.npz.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, mtime=stat.st_mtime_ns, size=stat.st_size, digest=digest,
+                     **{f'column_{idx}': column for idx, column in enumerate(columns)})
+        os.replace(tmp_path, cache_file)
+    except OSError:
+        # The cache is only an optimization, so a failed write is not fatal
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
-    return rounds
 
+def read_annotations(xlsx_file, nrows=None, use_cache=True):
+    """
+    Returns a DataFrame with the ANNOTATION_CATEGORIES columns of the first nrows (default: all) of a workbook
+    """
+    if not use_cache:
+        return read_xlsx_columns(xlsx_file, ANNOTATION_CATEGORIES, nrows)
 
-def calculate_differences(data):
-    # For each group, calculate their cohen's kappa
-    differences_data = {
-        'value': [],
-        'difference': [],
-        'category': [],
-        'round': [],
-        'group': []
-    }
+    stat = os.stat(xlsx_file)
+    cache_file = _cache_path(xlsx_file, nrows)
+    digest = None
 
-    print('attempting to calculate differences')
-    print(os.getcwd())
+    if os.path.exists(cache_file):
+        try:
+            with np.load(cache_file, allow_pickle=False) as cached:
+                columns = [cached[f'column_{idx}'] for idx in range(len(ANNOTATION_CATEGORIES))]
+                fresh = cached['mtime'] == stat.st_mtime_ns and cached['size'] == stat.st_size
+                cached_digest = str(cached['digest'])
+        except (OSError, KeyError, ValueError):
+            # Corrupt or outdated entry, re-parse below
+            columns = None
 
-    # Get number of rounds
-    ROUNDS = data.keys()
-    for ROUND_NUMBER in ROUNDS:
-        # for ROUND_NUMBER in range(1,ROUNDS):
-        round = data[ROUND_NUMBER]
-
-        GROUPS = round.keys()
-        for GROUP_NO in GROUPS:
-            group = round[GROUP_NO]
-
-            # For each annotation category, compile annotations
-            for annotation_category in ANNOTATION_CATEGORIES:
-
-                # Grab list of pd.Series, where each Series is a set of 50 annotations. Two Series per group
-                two_annotations = group[annotation_category]
-
-                raters = []
-                for annotations in two_annotations:
-                    raters.append(annotations)
-                # Read xlsx files into two different Series
-
-                difference_count = [0, 0, 0, 0, 0]  # Differences of 0, 1, 2, 3, 4
-
-                # Calculate differences in annotation values
-                if ROUND_NUMBER != 6:
-                    differences = np.absolute(raters[0] - raters[1])[:50].astype('int32')
-                else:
-                    differences = np.absolute(raters[0] - raters[1])[:400].astype('int32')
-                
-                for difference in differences:
-                    difference_count[difference] += 1
-
-                # Add info to master_dataframe
-                for idx, difference in enumerate(difference_count):
-                    # master_df = pd.DataFrame(columns=['value', 'difference', 'category', 'round', 'group'])
-                    row_dict = {'value': difference, 'difference': idx, 'category': annotation_category,
-                                'round': ROUND_NUMBER, 'group': GROUP_NO}
-
-                    differences_data['value'].append(difference)
-                    differences_data['difference'].append(idx)
-                    differences_data['category'].append(annotation_category)
-                    differences_data['round'].append(ROUND_NUMBER)
-                    differences_data['group'].append(GROUP_NO)
-
-    return pd.DataFrame(differences_data)
-
-
-def calculate_cohen_kappa(data):
-    kappa_data_list = {
-        'kappa_score': [],
-        'category': [],
-        'round': [],
-        'group': []
-    }
+        if columns is not None:
+            if not fresh:
+                # mtime changed (copy, touch, checkout), but the content might not have
+                digest = _file_digest(xlsx_file)
+                fresh = digest == cached_digest
+                if fresh:
+                    _write_cache(cache_file, columns, stat, digest)
 
-    print('attempting to calculate differences')
-    print(os.getcwd())
+            if fresh:
+                return pd.DataFrame(dict(zip(ANNOTATION_CATEGORIES, columns)))
 
-    # all possible annotation labels
-    labels = [1, 2, 3, 4, 5]
+    annotator_df = read_xlsx_columns(xlsx_file, ANNOTATION_CATEGORIES, nrows)
 
-    # Get number of rounds
-    ROUNDS = data.keys()
-    for ROUND_NUMBER in ROUNDS:
-        # for ROUND_NUMBER in range(1,ROUNDS):
-        round = data[ROUND_NUMBER]
+    if digest is None:
+        digest = _file_digest(xlsx_file)
+    _write_cache(cache_file, [annotator_df[category].to_numpy() for category in ANNOTATION_CATEGORIES],
+                 stat, digest)
 
-        GROUPS = round.keys()
-        for GROUP_NO in GROUPS:
-            group = round[GROUP_NO]
+    return annotator_df
 
-            # For each annotation category, compile annotations
-            for annotation_category in ANNOTATION_CATEGORIES:
 
-                # Grab list of pd.Series, where each Series is a set of 50 annotations. Two Series per group
-                two_annotations = group[annotation_category]
+"""
+Dense rater tensor.
 
-                raters = []
-                for annotations in two_annotations:
-                    raters.append(annotations)
-                # Read xlsx files into two different Series
+All annotations live in one int8 array shaped (round, rater, category, item), with MISSING for
+blank cells, padded items (rounds with fewer items) and padded raters (rounds with fewer raters).
+Within a round, raters are ordered by group. RaterMeta maps the rater axis back to groups and names.
+"""
 
-                kappa_data = np.zeros((len(raters), len(raters)))
 
-                # Calculate cohen_kappa_score for every combination of raters
-                # Combinations are only calculated j -> k, but not k -> j, which are equal
-                # So not all places in the matrix are filled.
-                for j, k in list(itertools.combinations(range(len(raters)), r=2)):
-                    kappa_data[j, k] = cohen_kappa_score(raters[j], raters[k], weights='linear', labels=labels)
+@dataclass
+class RaterMeta:
+    rounds: list  # Round number of each index along the round axis
+    groups: np.ndarray  # (round, rater) group number of each rater, 0 for padding
+    names: list  # names[round_idx][rater] annotator name
+    n_raters: np.ndarray  # Number of (unpadded) raters per round
+    n_items: np.ndarray  # Number of (unpadded) items per round
 
-                kappa_score = kappa_data[0][1]
-                # Add kappa score to dataframe
 
-                # master_df = pd.DataFrame(columns=['value', 'difference', 'category', 'round', 'group'])
-                row_dict = {'kappa_score': kappa_score, 'category': annotation_category,
-                            'round': ROUND_NUMBER, 'group': GROUP_NO}
+def annotator_name(xlsx_file):
+    # Annotator names are the [Name] prefix of each workbook
+    match = re.match(r'\[(.*?)\]', os.path.basename(xlsx_file))
+    return match.group(1) if match else os.path.splitext(os.path.basename(xlsx_file))[0]
 
-                kappa_data_list['kappa_score'].append(kappa_score)
-                kappa_data_list['category'].append(annotation_category)
-                kappa_data_list['round'].append(ROUND_NUMBER)
-                kappa_data_list['group'].append(GROUP_NO)
 
-    return pd.DataFrame(kappa_data_list)
+_aliases = {'stat': None, 'aliases': {}}
+
+
+def _normalize_name(name):
+    # The name in lower case, with '_' as a space
+    return ' '.join(name.replace('_', ' ').lower().split())
+
+
+def annotator_aliases():
+    """
+    Returns the aliases in ANNOTATOR_ALIASES_FILE ({name: name it stands for}, e.g. {"Professor": "Professor Sedoc"}),
+    by normalized name. Read again only when the file changes, no file means no aliases
+    """
+    try:
+        stat = os.stat(ANNOTATOR_ALIASES_FILE)
+    except FileNotFoundError:
+        return {}
+
+    if _aliases['stat'] != (stat.st_mtime_ns, stat.st_size):
+        with open(ANNOTATOR_ALIASES_FILE, encoding='utf-8') as f:
+            aliases = json.load(f)
+        _aliases['aliases'] = {_normalize_name(name): _normalize_name(alias) for name, alias in aliases.items()}
+        _aliases['stat'] = (stat.st_mtime_ns, stat.st_size)
+
+    return _aliases['aliases']
+
+
+def annotator_key(name):
+    # Identifies an annotator across rounds: the normalized name, with annotator_aliases applied
+    key = _normalize_name(name)
+    return annotator_aliases().get(key, key)
+
+
+def build_tensor(rounds, raters):
+    """
+    Builds the rater tensor from a list of (round, group, name, annotations) tuples, where
+    annotations maps each annotation category to its scores
+    """
+    round_index = {ROUND_NUMBER: idx for idx, ROUND_NUMBER in enumerate(rounds)}
+
+    # Keep raters grouped together within each round
+    raters = sorted(raters, key=lambda rater: (round_index[rater[0]], rater[1]))
+
+    n_raters = np.zeros(len(rounds), dtype=np.int64)
+    n_items = np.zeros(len(rounds), dtype=np.int64)
+    for ROUND_NUMBER, _, _, annotations in raters:
+        round_idx = round_index[ROUND_NUMBER]
+        n_raters[round_idx] += 1
+        n_items[round_idx] = max(n_items[round_idx], len(annotations[ANNOTATION_CATEGORIES[0]]))
+
+    scores = np.full((len(rounds), max(n_raters, default=0), len(ANNOTATION_CATEGORIES), max(n_items, default=0)),
+                     MISSING, dtype=np.int8)
+    groups = np.zeros(scores.shape[:2], dtype=np.int64)
+    names = [[''] * scores.shape[1] for _ in rounds]
+
+    next_rater = np.zeros(len(rounds), dtype=np.int64)
+    for ROUND_NUMBER, GROUP_NO, name, annotations in raters:
+        round_idx = round_index[ROUND_NUMBER]
+        rater_idx = next_rater[round_idx]
+        next_rater[round_idx] += 1
+
+        groups[round_idx, rater_idx] = GROUP_NO
+        names[round_idx][rater_idx] = name
+        for category_idx, annotation_category in enumerate(ANNOTATION_CATEGORIES):
+            values = pd.to_numeric(pd.Series(annotations[annotation_category]), errors='coerce').to_numpy()
+            values = np.where(np.isnan(values), MISSING, values)
+            scores[round_idx, rater_idx, category_idx, :len(values)] = values
+
+    return scores, RaterMeta(list(rounds), groups, names, n_raters, n_items)
+
+
+def to_tensor(data):
+    """
+    Converts the nested Round - Group - Category - annotations dicts from read_data into the rater tensor
+    """
+    raters = []
+    for ROUND_NUMBER, round in data.items():
+        for GROUP_NO, group in round.items():
+            for rater_idx in range(len(group[ANNOTATION_CATEGORIES[0]])):
+                annotations = {annotation_category: group[annotation_category][rater_idx]
+                               for annotation_category in ANNOTATION_CATEGORIES}
+                raters.append((ROUND_NUMBER, GROUP_NO, f'Rater {rater_idx + 1}', annotations))
+
+    return build_tensor(list(data.keys()), raters)
+
+
+def _as_tensor(data, meta):
+    # The calculate_* functions accept either read_data's nested dicts, or the tensor and its meta
+    if meta is None:
+        return to_tensor(data)
+    return data, meta
 
 
-def calculate_group_kappa(data):
-    print('attempting to calculate differences')
-    print(os.getcwd())
+def group_pairs(meta):
+    """
+    Returns (round_idx, group, first rater, second rater) arrays for the first two raters of every group
+    """
+    round_idx, group, first, second = [], [], [], []
+    for idx in range(len(meta.rounds)):
+        round_groups = meta.groups[idx]
+        for GROUP_NO in np.unique(round_groups[round_groups > 0]):
+            members = np.flatnonzero(round_groups == GROUP_NO)
+            if len(members) < 2:
+                continue
+            round_idx.append(idx)
+            group.append(GROUP_NO)
+            first.append(members[0])
+            second.append(members[1])
+
+    return tuple(np.array(values, dtype=np.int64) for values in (round_idx, group, first, second))
+
+
+"""
+Linear weighted Cohen's kappa, computed with array ops instead of one cohen_kappa_score call per pair.
+
+Scores are one-hot encoded over LABELS (MISSING and out-of-range scores encode to all zeros, so they
+drop out of every count), and the observed/expected disagreement of every pair comes out of a few
+batched matrix products. Results match sklearn's cohen_kappa_score(weights='linear', labels=LABELS)
+on the items both raters annotated.
+"""
+
+# |i - j| disagreement weights between labels
+LINEAR_WEIGHTS = np.abs(np.subtract.outer(np.arange(len(LABELS)), np.arange(len(LABELS)))).astype(np.float64)
+
+
+def _one_hot(scores):
+    # (..., item) -> (..., item, label). float32 keeps the matrix products fast, and counts exact
+    return (scores[..., None] == np.array(LABELS, dtype=scores.dtype)).astype(np.float32)
+
+
+def _kappa(observed, expected):
+    # kappa = 1 - observed disagreement / expected disagreement, NaN when nothing is expected to disagree
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return 1 - observed / np.where(expected == 0, np.nan, expected)
+
+
+def pairwise_kappa(scores):
+    """
+    Kappa between every pair of raters: (..., rater, item) scores -> (..., rater, rater) kappa matrix
+    """
+    one_hot = _one_hot(scores)  # (..., rater, item, label)
+    lead = one_hot.shape[:-3]
+    n_raters, n_items, n_labels = one_hot.shape[-3:]
+    valid = one_hot.sum(axis=-1)  # (..., rater, item)
+
+    # Number of items both raters annotated, (..., a, b)
+    n = (valid @ np.swapaxes(valid, -1, -2)).astype(np.float64)
+
+    # Label counts of rater a over the items rater b also annotated, (..., a, b, label)
+    marginals = np.swapaxes(one_hot, -1, -2).reshape(*lead, n_raters * n_labels, n_items) @ np.swapaxes(valid, -1, -2)
+    marginals = np.swapaxes(marginals.reshape(*lead, n_raters, n_labels, n_raters), -1, -2).astype(np.float64)
+
+    # Observed disagreement, sum over items of |a - b|, (..., a, b)
+    weighted = one_hot @ LINEAR_WEIGHTS.astype(np.float32)
+    observed = one_hot.reshape(*lead, n_raters, n_items * n_labels) @ \
+        np.swapaxes(weighted.reshape(*lead, n_raters, n_items * n_labels), -1, -2)
+
+    # Expected disagreement from each pair's label marginals, (..., a, b)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        expected = ((marginals @ LINEAR_WEIGHTS) * np.swapaxes(marginals, -2, -3)).sum(axis=-1) / n
+
+    return _kappa(observed.astype(np.float64), expected)
+
+
+def table_kappa(tables):
+    """
+    Kappa from contingency tables: (..., 5, 5) counts -> (...)
+    """
+    # Work on flattened (..., 25) cells, so every reduction is one small matrix product
+    cells = tables.reshape(*tables.shape[:-2], len(LABELS) * len(LABELS)).astype(np.float64)
+    first_marginal = cells @ _ROW_OF_CELL
+    second_marginal = cells @ _COLUMN_OF_CELL
+
+    observed = cells @ LINEAR_WEIGHTS.reshape(-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        expected = ((first_marginal @ LINEAR_WEIGHTS) * second_marginal).sum(axis=-1) / first_marginal.sum(axis=-1)
+
+    return _kappa(observed, expected)
+
+
+# Maps each flattened contingency table cell to its row / column, shaped (25, 5)
+_ROW_OF_CELL = np.repeat(np.eye(len(LABELS)), len(LABELS), axis=0)
+_COLUMN_OF_CELL = np.tile(np.eye(len(LABELS)), (len(LABELS), 1))
+
+
+"""
+Bootstrap confidence intervals.
+
+Resampling a pair's items with replacement and re-counting them is the same as drawing its contingency table
+from a multinomial over the observed cell frequencies. So all resamples of a table are drawn in one multinomial
+call, and scored with table_kappa, instead of re-running cohen_kappa_score thousands of times.
+Each table draws from its own generator, seeded from BOOTSTRAP_SEED and the table's key (round, group, category),
+so its interval doesn't depend on which other tables are computed with it.
+"""
+
+BOOTSTRAP_SAMPLES = 10000
+BOOTSTRAP_CONFIDENCE = 0.95
+# Fixed seed, so the intervals only change when the annotations do
+BOOTSTRAP_SEED = 0
+
+
+def bootstrap_kappa(tables, keys=None, n_samples=BOOTSTRAP_SAMPLES, confidence=BOOTSTRAP_CONFIDENCE,
+                    seed=BOOTSTRAP_SEED):
+    """
+    Percentile bootstrap interval of the kappa of contingency tables: (..., 5, 5) counts -> (low, high),
+    each shaped (...). keys, shaped (..., k) non-negative integers, seeds each table's generator
+    (default: the table's position)
+    """
+    lead = tables.shape[:-2]
+    cells = tables.reshape(-1, len(LABELS) * len(LABELS)).astype(np.int64)
+    n = cells.sum(axis=-1)
+    if keys is None:
+        keys = np.arange(len(n))[:, None]
+    else:
+        # An explicit key width, so no tables (rounds without a pair) give (0, k) keys rather than a reshape error
+        keys = np.asarray(keys, dtype=np.int64)
+        keys = keys.reshape(len(n), keys.shape[-1])
+
+    alpha = (1 - confidence) / 2
+    low, high = np.full(len(n), np.nan), np.full(len(n), np.nan)
+    # Empty tables keep a NaN interval
+    for idx in np.flatnonzero(n > 0):
+        rng = np.random.default_rng(np.random.SeedSequence([seed, *keys[idx].tolist()]))
+        resampled = rng.multinomial(n[idx], cells[idx] / n[idx], size=n_samples)
+        samples = table_kappa(resampled.reshape(n_samples, len(LABELS), len(LABELS)))
+        with warnings.catch_warnings():
+            # All-NaN samples (degenerate tables) just get a NaN interval
+            warnings.simplefilter('ignore', RuntimeWarning)
+            low[idx], high[idx] = np.nanquantile(samples, [alpha, 1 - alpha])
+
+    return low.reshape(lead), high.reshape(lead)
+
+
+"""
+Multi-rater agreement.
+
+Fleiss' kappa and ordinal Krippendorff's alpha for everyone in a round, both computed from per-item label counts
+(how many raters gave each item each score), so they cost O(raters * items) per round and category instead of
+a pass over every pair. Missing annotations simply don't count towards an item's labels, and items with fewer
+than two annotations are left out.
+"""
+
+
+def item_label_counts(scores):
+    """
+    Number of raters that gave each item each label: (..., rater, item) scores -> (..., item, label)
+    """
+    return _one_hot(scores).sum(axis=-3, dtype=np.float64)
+
+
+def fleiss_kappa(counts):
+    """
+    Fleiss' kappa from item label counts: (..., item, label) -> (...)
+    """
+    raters = counts.sum(axis=-1)  # Annotations per item
+    pairable = raters >= 2
+
+    # Observed agreement of each item, averaged over the items with at least two annotations
+    with np.errstate(divide='ignore', invalid='ignore'):
+        item_agreement = ((counts * (counts - 1)).sum(axis=-1) / (raters * (raters - 1)))
+        observed = np.where(pairable, item_agreement, 0).sum(axis=-1) / pairable.sum(axis=-1)
+
+        # Chance agreement from the overall label proportions
+        proportions = (counts * pairable[..., None]).sum(axis=-2)
+        proportions = proportions / proportions.sum(axis=-1, keepdims=True)
+        expected = (proportions ** 2).sum(axis=-1)
+
+        return (observed - expected) / np.where(expected == 1, np.nan, 1 - expected)
 
-    # all possible annotation labels
-    labels = [1, 2, 3, 4, 5]
-    # Get number of rounds
-    ROUNDS = data.keys()
+
+def krippendorff_alpha(counts):
+    """
+    Krippendorff's alpha with the ordinal metric, from item label counts: (..., item, label) -> (...)
+    """
+    raters = counts.sum(axis=-1)
+    pairable = raters >= 2
+
+    # Coincidence matrix: every ordered pair of annotations within an item, weighted by 1 / (annotations - 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weights = np.where(pairable, 1 / (raters - 1), 0)
+    weighted = counts * weights[..., None]
+    coincidences = np.swapaxes(weighted, -1, -2) @ counts
+    coincidences -= weighted.sum(axis=-2)[..., None] * np.eye(counts.shape[-1])
+
+    label_totals = coincidences.sum(axis=-1)  # (..., label)
+    total = label_totals.sum(axis=-1)
+
+    # Ordinal distance between labels c < k: (sum of totals from c to k - (total_c + total_k) / 2) ** 2
+    cumulative = np.cumsum(label_totals, axis=-1)
+    lower, upper = np.triu_indices(counts.shape[-1])
+    between = cumulative[..., upper] - cumulative[..., lower] + label_totals[..., lower]
+    distances = np.zeros(coincidences.shape)
+    distances[..., lower, upper] = (between - (label_totals[..., lower] + label_totals[..., upper]) / 2) ** 2
+    distances[..., upper, lower] = distances[..., lower, upper]
+
+    observed = (coincidences * distances).sum(axis=(-2, -1))
+    expected = (label_totals[..., :, None] * label_totals[..., None, :] * distances).sum(axis=(-2, -1))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return 1 - (total - 1) * observed / np.where(expected == 0, np.nan, expected)
+
+
+"""
+Metrics.
+
+The per-group outputs (differences, kappa, contingency tables) all come from the contingency tables of
+each group's first two raters, and the per-round outputs from one batched pairwise_kappa call (group kappa)
+and one pass over the item label counts (multi-rater agreement).
+compute_metrics shares those between every output, so each (round, group, category) slice is visited once.
+"""
+
+DashboardData = namedtuple('DashboardData', ['differences', 'kappa', 'annotations', 'group_kappa', 'contingency',
+                                             'multi_rater', 'raters', 'items', 'annotators', 'item_scores'])
+
+# Maps each flattened (first score, second score) cell to its absolute difference, shaped (25, 5)
+DIFFERENCE_BINS = (LINEAR_WEIGHTS.reshape(-1)[:, None] == np.arange(len(LABELS))).astype(np.int64)
+
+
+def _contingency(scores, meta):
+    """
+    Returns (tables, round_pos, group_pos, rounds, groups): the stacked (round, group, category, 5, 5)
+    contingency tables, the position of every group pair along their round and group axes, and the axis labels
+    """
+    round_idx, group, first, second = group_pairs(meta)
+    rounds, round_pos = np.unique(np.array(meta.rounds)[round_idx], return_inverse=True)
+    groups, group_pos = np.unique(group, return_inverse=True)
+    n_categories, n_labels = len(ANNOTATION_CATEGORIES), len(LABELS)
+
+    # Encode every (round, group, category, first score, second score) as one bin, shaped (pair, category, item)
+    first_scores = scores[round_idx, first].astype(np.int64)
+    second_scores = scores[round_idx, second].astype(np.int64)
+    slice_idx = (round_pos * len(groups) + group_pos)[:, None] * n_categories + np.arange(n_categories)
+    bins = (slice_idx[..., None] * n_labels + first_scores - 1) * n_labels + second_scores - 1
+
+    valid = np.isin(first_scores, LABELS) & np.isin(second_scores, LABELS)
+    tables = np.bincount(bins[valid], minlength=len(rounds) * len(groups) * n_categories * n_labels * n_labels)
+    tables = tables.reshape(len(rounds), len(groups), n_categories, n_labels, n_labels)
+
+    return tables, round_pos, group_pos, rounds, groups
+
+
+def _differences_frame(tables, round_pos, group_pos, rounds, groups):
+    # Count differences of 0, 1, 2, 3, 4, shaped (pair, category, difference)
+    pair_tables = tables[round_pos, group_pos]
+    n_pairs, n_categories = pair_tables.shape[:2]
+    difference_count = pair_tables.reshape(n_pairs, n_categories, len(LABELS) * len(LABELS)) @ DIFFERENCE_BINS
+    n_differences = difference_count.shape[-1]
+
+    return pd.DataFrame({
+        'value': difference_count.ravel(),
+        'difference': np.tile(np.arange(n_differences), n_pairs * n_categories),
+        'category': np.tile(np.repeat(ANNOTATION_CATEGORIES, n_differences), n_pairs),
+        'round': np.repeat(rounds[round_pos], n_categories * n_differences),
+        'group': np.repeat(groups[group_pos], n_categories * n_differences),
+    })
+
+
+def _kappa_frame(tables, round_pos, group_pos, rounds, groups):
+    # Kappa between the first two raters of every group (and its bootstrap interval), shaped (pair, category)
+    pair_tables = tables[round_pos, group_pos]
+    kappa_scores = table_kappa(pair_tables)
+    n_pairs, n_categories = kappa_scores.shape
+    # Seed every table's resampling by its (round, group, category)
+    keys = np.stack(np.broadcast_arrays(rounds[round_pos][:, None], groups[group_pos][:, None],
+                                        np.arange(n_categories)), axis=-1)
+    kappa_low, kappa_high = bootstrap_kappa(pair_tables, keys)
+
+    return pd.DataFrame({
+        'kappa_score': kappa_scores.ravel(),
+        'kappa_low': kappa_low.ravel(),
+        'kappa_high': kappa_high.ravel(),
+        'category': np.tile(ANNOTATION_CATEGORIES, n_pairs),
+        'round': np.repeat(rounds[round_pos], n_categories),
+        'group': np.repeat(groups[group_pos], n_categories),
+    })
+
+
+def _group_kappa_dict(scores, meta):
+    # Kappa for every pair of raters, in every round and category, shaped (round, category, rater, rater)
+    kappa_data = pairwise_kappa(np.swapaxes(scores, 1, 2))
+
+    # Pairs are symmetric, so only keep j -> k, but not k -> j (or j -> j)
+    upper_triangle = np.triu(np.ones(kappa_data.shape[-2:], dtype=bool), k=1)
+    kappa_data = np.where(upper_triangle, kappa_data, np.nan)
 
     # Master list of all rounds
     all_rounds = {}
 
-    for ROUND_NUMBER in ROUNDS:
-        all_rounds[ROUND_NUMBER] = {}  # To be filled with annotation specific kappa scores
-        # for ROUND_NUMBER in range(1,ROUNDS):
-        round = data[ROUND_NUMBER]
-
-        # New set of raters per round
-        raters = {
-            'Appropriateness': [],
-            'Information content of outputs': [],
-            'Humanlikeness': []
+    for idx, ROUND_NUMBER in enumerate(meta.rounds):
+        n_raters = meta.n_raters[idx]
+        all_rounds[ROUND_NUMBER] = {
+            annotation_category: kappa_data[idx, category_idx, :n_raters, :n_raters]
+            for category_idx, annotation_category in enumerate(ANNOTATION_CATEGORIES)
         }
 
-        # For each round, grab all raters
-        GROUPS = round.keys()
-        for GROUP_NO in GROUPS:
-            group = round[GROUP_NO]
+    return all_rounds
 
-            # For each annotation category, compile annotations
-            for annotation_category in ANNOTATION_CATEGORIES:
 
-                # Grab list of pd.Series, where each Series is a set of 50 annotations. Two Series per group
-                two_annotations = group[annotation_category]
+def _count_frame(scores, meta):
+    """
+    Number of annotations of every score, one row per round - group - category - score that occurs
+    (columns annotation, count, category, round, group)
+    """
+    groups = np.unique(meta.groups[meta.groups > 0])
+    n_categories, n_labels = len(ANNOTATION_CATEGORIES), len(LABELS)
+
+    # Encode every (round, group, category, score) as one bin, shaped like scores
+    round_idx, _, category_idx, _ = np.indices(scores.shape, sparse=True)
+    group_pos = np.searchsorted(groups, meta.groups)[:, :, None, None]
+    bins = ((round_idx * len(groups) + group_pos) * n_categories + category_idx) * n_labels \
+        + scores.astype(np.int64) - 1
+
+    valid = np.isin(scores, LABELS)
+    counts = np.bincount(bins[valid], minlength=len(meta.rounds) * len(groups) * n_categories * n_labels)
+    counts = counts.reshape(len(meta.rounds), len(groups), n_categories, n_labels)
+    round_pos, group_pos, category_pos, label_pos = np.nonzero(counts)
+
+    return pd.DataFrame({
+        'annotation': np.array(LABELS, dtype=np.int64)[label_pos],
+        'count': counts[round_pos, group_pos, category_pos, label_pos],
+        'category': np.array(ANNOTATION_CATEGORIES)[category_pos],
+        'round': np.array(meta.rounds, dtype=np.int64)[round_pos],
+        'group': groups[group_pos],
+    })
+
+
+def _rater_frame(meta):
+    # Who each row / column of the group kappa matrices is: one row per (round, rater)
+    round_idx, rater_idx = np.nonzero(np.arange(meta.groups.shape[1]) < meta.n_raters[:, None])
+
+    return pd.DataFrame({
+        'round': np.array(meta.rounds, dtype=np.int64)[round_idx],
+        'rater': rater_idx,
+        'group': meta.groups[round_idx, rater_idx],
+        'name': [meta.names[idx][rater] for idx, rater in zip(round_idx, rater_idx)],
+    })
+
+
+def _multi_rater_frame(scores, meta):
+    # Agreement between everyone in a round, shaped (round, category)
+    counts = item_label_counts(np.swapaxes(scores, 1, 2))
+    fleiss = fleiss_kappa(counts)
+    alpha = krippendorff_alpha(counts)
+    n_rounds, n_categories = fleiss.shape
+
+    return pd.DataFrame({
+        'fleiss_kappa': fleiss.ravel(),
+        'krippendorff_alpha': alpha.ravel(),
+        'raters': np.repeat(meta.n_raters, n_categories),
+        'category': np.tile(ANNOTATION_CATEGORIES, n_rounds),
+        'round': np.repeat(np.array(meta.rounds, dtype=np.int64), n_categories),
+    })
+
+
+def _item_frame(scores, meta, item_text=None):
+    """
+    Disagreement on every item: one row per round - group - category - item with at least two annotations, where
+    group 0 stands for all raters of the round. Columns round, group, category, item (position in the round),
+    raters, mean, spread (highest - lowest score), mean_difference (mean absolute difference over every pair of
+    raters), lowest and highest (one of the raters who gave the lowest / highest score), and the ITEM_COLUMNS
+    from item_text ({round: read_item_text output}, empty strings where missing).
+    Returns (frame, scores), where scores, shaped (row, rater), holds the score every rater of the row's group
+    gave the item (MISSING for everyone else), raters numbered like the rater column of _rater_frame. The
+    pairwise differences behind mean_difference, and who gave which score, come from there
+    """
+    groups = np.concatenate([[0], np.unique(meta.groups[meta.groups > 0])])
+    n_rounds, max_raters, n_categories, n_items = scores.shape
+    n_labels = len(LABELS)
+
+    # Label counts of every (round, group, category, item), encoded as one bin like in _count_frame
+    round_idx, _, category_idx, item_idx = np.indices(scores.shape, sparse=True)
+    group_pos = np.searchsorted(groups, meta.groups)[:, :, None, None]
+    bins = (((round_idx * len(groups) + group_pos) * n_categories + category_idx) * n_items + item_idx) * n_labels \
+        + scores.astype(np.int64) - 1
+
+    valid = np.isin(scores, LABELS)
+    counts = np.bincount(bins[valid], minlength=n_rounds * len(groups) * n_categories * n_items * n_labels)
+    counts = counts.reshape(n_rounds, len(groups), n_categories, n_items, n_labels)
+    counts[:, 0] = counts[:, 1:].sum(axis=1)
+
+    round_pos, group_pos, category_pos, item_pos = np.nonzero(counts.sum(axis=-1) >= 2)
+    counts = counts[round_pos, group_pos, category_pos, item_pos]
+    raters = counts.sum(axis=-1)
+
+    # Spread from the lowest and highest label used, the pairwise differences from the label counts
+    scored = counts > 0
+    low = scored.argmax(axis=-1)
+    high = n_labels - 1 - scored[:, ::-1].argmax(axis=-1)
+    pair_differences = ((counts @ LINEAR_WEIGHTS) * counts).sum(axis=-1) / 2
+
+    # Who gave the lowest / highest score, among the raters of the row's group
+    members = np.where(groups[group_pos, None] == 0, np.arange(max_raters) < meta.n_raters[round_pos, None],
+                       meta.groups[round_pos] == groups[group_pos, None])
+    row_scores = scores[round_pos, :, category_pos, item_pos]
+    names = np.array([list(round_names) for round_names in meta.names], dtype=object).reshape(n_rounds, max_raters)
+    lowest, highest = (
+        (members & (row_scores == np.array(LABELS)[label, None])).argmax(axis=-1) if max_raters else label
+        for label in (low, high)
+    )
+
+    df = pd.DataFrame({
+        'round': np.array(meta.rounds, dtype=np.int64)[round_pos],
+        'group': groups[group_pos],
+        'category': np.array(ANNOTATION_CATEGORIES)[category_pos],
+        'item': item_pos,
+        'raters': raters,
+        'mean': (counts @ np.array(LABELS)) / raters,
+        'spread': high - low,
+        'mean_difference': pair_differences / (raters * (raters - 1) / 2),
+        'lowest': names[round_pos, lowest],
+        'highest': names[round_pos, highest],
+    })
+
+    # Item text, padded to the round's items
+    item_text = item_text or {}
+    for column in ITEM_COLUMNS:
+        text = np.full((n_rounds, n_items), '', dtype=object)
+        for idx, ROUND_NUMBER in enumerate(meta.rounds):
+            if ROUND_NUMBER in item_text:
+                values = item_text[ROUND_NUMBER][column].to_numpy()[:n_items]
+                text[idx, :len(values)] = values
+        df[column] = text[round_pos, item_pos]
+
+    return df, np.where(members, row_scores, MISSING).astype(np.int8)
+
+
+def _annotator_frame(scores, meta, group_kappa):
+    """
+    Agreement of every annotator, one row per round - annotator - category (columns round, annotator, category, name,
+    partner_kappa, consensus_kappa, bias, drift). partner_kappa averages the annotator's kappa with the other
+    raters of their group (from the group_kappa matrices), consensus_kappa is their kappa with the median score of
+    every other rater of the round, bias the mean of (their score - that median), and drift is set by
+    _annotator_drift. Annotators are told apart by annotator_key (the annotator column), name is the [Name] they
+    signed with, and an annotator rating in several groups of a round gets the mean of those raters
+    """
+    n_rounds, max_raters = scores.shape[:2]
+
+    # Leave-one-out consensus: label counts of every item without the rater's own label, (round, rater, category,
+    # item, label), and their lower median
+    one_hot = _one_hot(scores)
+    others = one_hot.sum(axis=1, keepdims=True) - one_hot
+    n_others = others.sum(axis=-1)
+    median = (2 * np.cumsum(others, axis=-1) >= n_others[..., None]).argmax(axis=-1)
+    paired = (one_hot.sum(axis=-1) > 0) & (n_others > 0)
+
+    consensus = np.where(paired[..., None], np.eye(len(LABELS), dtype=np.float32)[median], 0)
+    tables = np.einsum('rnkil,rnkim->rnklm', one_hot, consensus)
+    consensus_kappa = table_kappa(tables)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        bias = (np.where(paired, scores - np.array(LABELS)[median], 0).sum(axis=-1) / paired.sum(axis=-1))
+
+    # Mean kappa with the other raters of the same group: the stored upper triangles, made symmetric
+    partner_kappa = np.full(consensus_kappa.shape, np.nan)
+    for round_idx, ROUND_NUMBER in enumerate(meta.rounds):
+        n_raters = meta.n_raters[round_idx]
+        matrices = np.stack([np.asarray(group_kappa[ROUND_NUMBER][category]) for category in ANNOTATION_CATEGORIES])
+        matrices = np.fmax(matrices, np.swapaxes(matrices, -1, -2))
+        round_groups = meta.groups[round_idx, :n_raters]
+        partners = (round_groups[:, None] == round_groups[None, :]) & ~np.eye(n_raters, dtype=bool)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)  # Raters without a partner, or no kappa with them
+            partner_kappa[round_idx, :n_raters] = np.nanmean(np.where(partners, matrices, np.nan), axis=-1).T
+
+    round_idx, rater_idx = np.nonzero(np.arange(max_raters) < meta.n_raters[:, None])
+    n_rows, n_categories = len(round_idx), len(ANNOTATION_CATEGORIES)
+    df = pd.DataFrame({
+        'round': np.repeat(np.array(meta.rounds, dtype=np.int64)[round_idx], n_categories),
+        'annotator': np.repeat([annotator_key(meta.names[idx][rater]) for idx, rater in zip(round_idx, rater_idx)],
+                               n_categories),
+        'name': np.repeat([meta.names[idx][rater] for idx, rater in zip(round_idx, rater_idx)], n_categories),
+        'category': np.tile(ANNOTATION_CATEGORIES, n_rows),
+        'partner_kappa': partner_kappa[round_idx, rater_idx].ravel(),
+        'consensus_kappa': consensus_kappa[round_idx, rater_idx].ravel(),
+        'bias': bias[round_idx, rater_idx].ravel(),
+    })
+    df = df.groupby(['round', 'annotator', 'category'], as_index=False, sort=False).agg(
+        {'name': 'first', 'partner_kappa': 'mean', 'consensus_kappa': 'mean', 'bias': 'mean'})
+
+    return _annotator_drift(df)
+
+
+def _annotator_drift(df):
+    """
+    Sets the drift of every row of an _annotator_frame: its consensus_kappa minus the annotator's mean
+    consensus_kappa over their earlier rounds (NaN in their first round), and its name to the one the annotator
+    signed their latest round with. Rows come back in annotator - category - round order
+    """
+    df = df.sort_values(['annotator', 'category', 'round'], ignore_index=True, kind='stable')
+    df['name'] = df['name'].astype(object).groupby(df['annotator'], sort=False).transform('last')
+    kappa, scored = df['consensus_kappa'].fillna(0), df['consensus_kappa'].notna().astype(np.int64)
+    keys = [df['annotator'], df['category']]
+
+    # Running totals per annotator and category, minus the row itself
+    earlier_sum = kappa.groupby(keys, sort=False).cumsum() - kappa
+    earlier_count = scored.groupby(keys, sort=False).cumsum() - scored
+    df['drift'] = df['consensus_kappa'] - earlier_sum / earlier_count.where(earlier_count > 0)
+
+    return df
+
+
+def calculate_differences(data, meta=None):
+    scores, meta = _as_tensor(data, meta)
 
-                for annotations in two_annotations:
-                    raters[annotation_category].append(annotations)
-                # Read xlsx files into two different Series
+    print('attempting to calculate differences')
+    print(os.getcwd())
 
-        for annotation_category in ANNOTATION_CATEGORIES:
-            kappa_rater = raters[annotation_category]  # List of all raters for the category, for this round
-            kappa_data = np.zeros((len(kappa_rater), len(kappa_rater)))
-            # Calculate cohen_kappa_score for every combination of raters
-            # Combinations are only calculated j -> k, but not k -> j, which are equal
-            # So not all places in the matrix are filled.
-            for j, k in list(itertools.combinations(range(len(kappa_rater)), r=2)):
-                kappa_data[j, k] = cohen_kappa_score(kappa_rater[j], kappa_rater[k], weights='linear', labels=labels)
+    return _differences_frame(*_contingency(scores, meta))
 
-            for j in range(len(kappa_rater)):
-                for k in range(len(kappa_rater)):
-                    if kappa_data[j, k] == float(0):
-                        kappa_data[j, k] = None
 
-            all_rounds[ROUND_NUMBER][annotation_category] = kappa_data
+def calculate_cohen_kappa(data, meta=None):
+    scores, meta = _as_tensor(data, meta)
+
+    print('attempting to calculate differences')
+    print(os.getcwd())
+
+    return _kappa_frame(*_contingency(scores, meta))
 
-    return all_rounds
 
+def calculate_group_kappa(data, meta=None):
+    scores, meta = _as_tensor(data, meta)
 
-def calculate_count(data):
-    annotation_data = {
-        'annotation': [],
-        'category': [],
-        'round': [],
-        'group': []
-    }
-    # annotation_df = pd.DataFrame(columns=['annotation', 'category', 'round', 'group'])
     print('attempting to calculate differences')
     print(os.getcwd())
 
-    # Get number of rounds
-    ROUNDS = data.keys()
-    for ROUND_NUMBER in ROUNDS:
-        # for ROUND_NUMBER in range(1,ROUNDS):
-        round = data[ROUND_NUMBER]
+    return _group_kappa_dict(scores, meta)
 
-        GROUPS = round.keys()
-        for GROUP_NO in GROUPS:
-            group = round[GROUP_NO]
 
-            # For each annotation category, compile annotations
-            for annotation_category in ANNOTATION_CATEGORIES:
+def calculate_count(data, meta=None):
+    scores, meta = _as_tensor(data, meta)
 
-                # Grab list of pd.Series, where each Series is a set of 50 annotations. Two Series per group
-                two_annotations = group[annotation_category]
+    print('attempting to calculate differences')
+    print(os.getcwd())
 
-                raters = []
-                for annotations in two_annotations:
-                    raters.extend(annotations)
-                # Read xlsx files into two different Series
+    return _count_frame(scores, meta)
+
+
+def create_contingency_table(data, meta=None):
+    """
+    Returns every contingency table stacked into one (round, group, category, 5, 5) count array,
+    where rows are the first rater's scores and columns are the second rater's.
+    The round and group axes are the sorted rounds and groups that have a pair of raters
+    (the same ones calculate_cohen_kappa reports)
+    """
+    scores, meta = _as_tensor(data, meta)
+
+    return _contingency(scores, meta)[0]
+
+
+def calculate_multi_rater_agreement(data, meta=None):
+    """
+    Returns Fleiss' kappa and ordinal Krippendorff's alpha between all raters of each round, per category
+    """
+    scores, meta = _as_tensor(data, meta)
+
+    return _multi_rater_frame(scores, meta)
+
+
+def calculate_item_disagreement(data, meta=None, item_text=None):
+    """
+    Returns the disagreement of every item, within each group and within each round, see _item_frame
+    """
+    scores, meta = _as_tensor(data, meta)
+
+    return _item_frame(scores, meta, item_text)[0]
+
+
+def calculate_annotator_consistency(data, meta=None):
+    """
+    Returns every annotator's agreement with their partners and with the round consensus, and its drift across
+    rounds, see _annotator_frame
+    """
+    scores, meta = _as_tensor(data, meta)
+
+    return _annotator_frame(scores, meta, _group_kappa_dict(scores, meta))
+
+
+@timed('compute_metrics')
+def compute_metrics(data, meta=None, item_text=None):
+    """
+    Computes every get_dfs output in one pass. item_text is passed on to _item_frame
+    """
+    scores, meta = _as_tensor(data, meta)
+
+    with timed('compute_metrics.contingency'):
+        contingency = _contingency(scores, meta)
+    with timed('compute_metrics.differences'):
+        differences = _differences_frame(*contingency)
+    with timed('compute_metrics.kappa'):
+        kappa = _kappa_frame(*contingency)
+    with timed('compute_metrics.annotations'):
+        annotations = _count_frame(scores, meta)
+    with timed('compute_metrics.group_kappa'):
+        group_kappa = _group_kappa_dict(scores, meta)
+    with timed('compute_metrics.multi_rater'):
+        multi_rater = _multi_rater_frame(scores, meta)
+    with timed('compute_metrics.items'):
+        items, item_scores = _item_frame(scores, meta, item_text)
+    with timed('compute_metrics.annotators'):
+        annotators = _annotator_frame(scores, meta, group_kappa)
+
+    return DashboardData(
+        differences=differences,
+        kappa=kappa,
+        annotations=annotations,
+        group_kappa=group_kappa,
+        contingency=contingency[0],
+        multi_rater=multi_rater,
+        raters=_rater_frame(meta),
+        items=items,
+        annotators=annotators,
+        item_scores=item_scores,
+    )
+
+
+@timed('merge_metrics')
+def merge_metrics(parts):
+    """
+    Merges DashboardData computed for separate rounds (in round order) into one
+    """
+    parts = [part for part in parts if part is not None]
+    if not parts:
+        return compute_metrics(*build_tensor([], []))
+
+    # The contingency tables of each part only cover its own groups, so line them up on the union of all groups
+    part_groups = [np.unique(part.kappa['group']) for part in parts]
+    groups = np.unique(np.concatenate(part_groups))
+    contingency = np.zeros((sum(len(part.contingency) for part in parts), len(groups)) + parts[0].contingency.shape[2:],
+                           dtype=np.int64)
+    round_pos = 0
+    for part, group in zip(parts, part_groups):
+        contingency[round_pos:round_pos + len(part.contingency), np.searchsorted(groups, group)] = part.contingency
+        round_pos += len(part.contingency)
+    max_raters = max(part.item_scores.shape[1] for part in parts)
+
+    return DashboardData(
+        differences=pd.concat([part.differences for part in parts], ignore_index=True),
+        kappa=pd.concat([part.kappa for part in parts], ignore_index=True),
+        annotations=pd.concat([part.annotations for part in parts], ignore_index=True),
+        group_kappa={ROUND_NUMBER: kappa for part in parts for ROUND_NUMBER, kappa in part.group_kappa.items()},
+        contingency=contingency,
+        multi_rater=pd.concat([part.multi_rater for part in parts], ignore_index=True),
+        raters=pd.concat([part.raters for part in parts], ignore_index=True),
+        items=pd.concat([part.items for part in parts], ignore_index=True),
+        # Drift compares rounds, so it's only right once every round is in
+        annotators=_annotator_drift(pd.concat([part.annotators for part in parts], ignore_index=True)),
+        # Rows line up with items, raters padded to the round with the most
+        item_scores=np.concatenate([
+            np.pad(part.item_scores, ((0, 0), (0, max_raters - part.item_scores.shape[1])), constant_values=MISSING)
+            for part in parts
+        ]),
+    )
 
-                for annotation_score in raters:
-                    # master_df = pd.DataFrame(columns=['value', 'difference', 'category', 'round', 'group'])
 
-                    annotation_data['annotation'].append(annotation_score)
-                    annotation_data['category'].append(annotation_category)
-                    annotation_data['round'].append(ROUND_NUMBER)
-                    annotation_data['group'].append(GROUP_NO)
+"""
+Indexed lookups into the get_dfs frames.
 
-    return pd.DataFrame(annotation_data)
+index_metrics makes one pass over each frame and maps every key the figure builders look up
+(category / group / round combinations) to its row positions, so each lookup is a dict access
+instead of a boolean scan of the whole frame. The items frame is indexed most contentious first, so the top K
+items of any key are its first K positions.
+"""
 
+MetricIndex = namedtuple('MetricIndex', ['kappa', 'kappa_cells', 'differences', 'annotations', 'multi_rater',
+                                         'raters', 'items', 'item_cells', 'annotators'])
 
-def create_contingency_table(data):
-    # Get number of rounds
-    ROUNDS = data.keys()
+_NO_ROWS = np.array([], dtype=np.intp)
 
-    # Master list of all rounds
-    all_rounds = {}
 
-    for ROUND_NUMBER in ROUNDS:
-        all_rounds[ROUND_NUMBER] = {}  # To be filled with annotation specific kappa scores
-        # for ROUND_NUMBER in range(1,ROUNDS):
-        round = data[ROUND_NUMBER]
+def row_positions(df, keys):
+    # {(key values): row positions}, in frame order
+    if df.empty:
+        return {}
+    positions = df.groupby(keys, sort=False, observed=True).indices
+    return {key if isinstance(key, tuple) else (key,): rows for key, rows in positions.items()}
 
-        # For each round, grab all raters
-        GROUPS = round.keys()
-        for GROUP_NO in GROUPS:
 
-            # 3 Contingency table per round for each group
-            contingency_tables = {
-                # Each category is a 5 x 5 matrix
-                'Appropriateness': np.zeros((5, 5)),
-                'Information content of outputs': np.zeros((5, 5)),
-                'Humanlikeness': np.zeros((5, 5)),
-            }
+def ranked_positions(df, keys, order):
+    # Like row_positions, but the positions of each key follow order instead of the frame order
+    return {key: order[rows] for key, rows in row_positions(df[keys].take(order), keys).items()}
 
-            group = round[GROUP_NO]
 
-            # For each annotation category, compile annotations
-            for annotation_category in ANNOTATION_CATEGORIES:
+def item_order(items):
+    # Row positions of the items frame, most contentious first: by mean_difference, then spread
+    return np.lexsort((items['item'], items['round'], -items['spread'], -items['mean_difference']))
 
-                # Grab list of pd.Series, where each Series is a set of 50 annotations. Two Series per group
-                two_annotations = group[annotation_category]
 
-                # Get each annotation1 - annotation2 pair for each prompt
-                # Fill it inside the contingency table
-                for idx in range(len(two_annotations[0])):
-                    # Grab the annotation scores for both raters
-                    first_score = two_annotations[0][idx]
-                    second_score = two_annotations[1][idx]
+@timed('index_metrics')
+def index_metrics(data):
+    """
+    Returns a MetricIndex over a DashboardData, each field mapping a key tuple to row positions:
+    kappa by (category, group), kappa_cells by (category, round, group), differences, annotations and
+    multi_rater by (category,), raters by (round,), items by (category, group) and item_cells by
+    (category, round, group), both most contentious first (see item_order), annotators by (category, annotator),
+    in round order
+    """
+    order = item_order(data.items)
 
-                    # Add count to the annotation - annotation pairing
-                    contingency_tables[annotation_category][int(first_score - 1)][int(second_score - 1)] += 1
+    return MetricIndex(
+        kappa=row_positions(data.kappa, ['category', 'group']),
+        kappa_cells=row_positions(data.kappa, ['category', 'round', 'group']),
+        differences=row_positions(data.differences, ['category']),
+        annotations=row_positions(data.annotations, ['category']),
+        multi_rater=row_positions(data.multi_rater, ['category']),
+        raters=row_positions(data.raters, ['round']),
+        items=ranked_positions(data.items, ['category', 'group'], order),
+        item_cells=ranked_positions(data.items, ['category', 'round', 'group'], order),
+        annotators=row_positions(data.annotators, ['category', 'annotator']),
+    )
 
-            # Add contingency table for this group for this round
-            all_rounds[ROUND_NUMBER][GROUP_NO] = contingency_tables
 
-    return all_rounds
+def metric_rows(df, positions, *key):
+    # Rows of df for one key of a MetricIndex field, no rows when the key isn't there
+    return df.take(positions.get(key, _NO_ROWS))
+
+
+"""
+Incremental recomputation.
+
+get_dfs fingerprints every workbook by (path, mtime, size) and keeps the outputs of each round, keyed by the
+fingerprints of its workbooks. Only the rounds containing a changed workbook are recomputed (their workbooks come
+from the read_annotations cache, so only the changed ones are parsed again), and the result is merged with the
+kept outputs of every other round. When nothing changed, the previous result is returned as is.
+
+The round outputs are kept in a mapping from round_key to DashboardData, this process' _round_metrics by default.
+store_utils passes a mapping backed by the shared store instead, so they are mapped rather than held by whichever
+worker last recomputed, and the next worker to recompute starts from them.
+"""
+
+_state_lock = threading.Lock()
+_round_metrics = {}  # round_key -> DashboardData
+_latest = {'version': None, 'data': None}
+
+
+@timed('fingerprint_annotations')
+def fingerprint_annotations(catalog=None):
+    """
+    Returns {(round, group): ((path, mtime, size), ...)} for every group in the annotations tree
+    """
+    if catalog is None:
+        catalog = annotation_catalog()
+
+    fingerprint = {}
+    for entry in catalog:
+        fingerprint.setdefault((entry.round, entry.group), []).append(
+            (entry.path, entry.mtime_ns, entry.size))
+
+    return {key: tuple(files) for key, files in fingerprint.items()}
+
+
+def annotations_version(fingerprint=None):
+    # A short digest of the whole annotations tree, changes whenever any workbook or annotator_aliases does
+    if fingerprint is None:
+        fingerprint = fingerprint_annotations()
+    return hashlib.sha1(repr((sorted(fingerprint.items()), sorted(annotator_aliases().items())))
+                        .encode('utf-8')).hexdigest()
 
 
 def get_dfs():
-    print('get df ran again :(')
-    # Grab data
-    data = read_data()
-
-    # Grab DFs
-    difference_df = calculate_differences(data)
-    kappa_df = calculate_cohen_kappa(data)
-    annotation_df = calculate_count(data)
-    group_kappa_data = calculate_group_kappa(data)
-    contingency_table = create_contingency_table(data)
-
-    return difference_df, kappa_df, annotation_df, group_kappa_data, contingency_table
+    """
+    Returns the DashboardData of the annotations tree. It keeps growing fields (differences, kappa, annotations,
+    group_kappa, contingency, multi_rater, raters, items, annotators, item_scores so far), so read it by attribute
+    or index rather than unpacking it into a fixed number of names
+    """
+    return get_versioned_dfs()[1]
+
+
+def round_key(ROUND_NUMBER, round_fingerprint):
+    # Names the outputs of a round computed from the given workbooks (and annotator_aliases)
+    return hashlib.sha1(repr((ROUND_NUMBER, round_fingerprint, sorted(annotator_aliases().items())))
+                        .encode('utf-8')).hexdigest()
+
+
+@timed('get_dfs')
+def get_versioned_dfs(round_metrics=None, keep=True):
+    """
+    Returns (version, get_dfs output), where version is the annotations_version the output was computed from.
+    round_metrics is where the outputs of each round are kept (_round_metrics by default), keep=False leaves the
+    merged output to the caller instead of keeping it for the next call
+    """
+    if round_metrics is None:
+        round_metrics = _round_metrics
+
+    catalog = annotation_catalog()
+    fingerprint = fingerprint_annotations(catalog)
+    version = annotations_version(fingerprint)
+
+    with _state_lock:
+        if _latest['version'] == version:
+            count('get_dfs.hit')
+            return version, _latest['data']
+
+        count('get_dfs.miss')
+        print('get df ran again :(')
+
+        rounds = sorted({entry.round for entry in catalog})
+        keys = {ROUND_NUMBER: round_key(ROUND_NUMBER, tuple(fingerprint[key] for key in sorted(fingerprint)
+                                                            if key[0] == ROUND_NUMBER))
+                for ROUND_NUMBER in rounds}
+
+        # Forget rounds that were removed or changed
+        for key in set(round_metrics) - set(keys.values()):
+            del round_metrics[key]
+
+        # Recompute only the rounds containing a changed group
+        parts = []
+        for ROUND_NUMBER in rounds:
+            if keys[ROUND_NUMBER] not in round_metrics:
+                entries = [entry for entry in catalog if entry.round == ROUND_NUMBER]
+                raters = [(entry.round, entry.group, entry.name, annotator_df)
+                          for entry, annotator_df in zip(entries, load_workbooks(entries))]
+                # Every workbook of a round holds the same items, take their text from the first one
+                item_text = {ROUND_NUMBER: read_item_text(entries[0].path)}
+                round_metrics[keys[ROUND_NUMBER]] = compute_metrics(*build_tensor([ROUND_NUMBER], raters), item_text)
+
+            parts.append(round_metrics[keys[ROUND_NUMBER]])
+
+        # One DashboardData, see get_dfs
+        data = merge_metrics(parts)
+        _latest['version'], _latest['data'] = (version, data) if keep else (None, None)
+        return version, data
@@ -0,0 +1,90 @@
+"""
+Lightweight timing and counter instrumentation.
+
+Stages are timed with timed(), either as a decorator or a with block, and events are counted with count().
+Totals live in this process (each gunicorn worker keeps its own) and are served as JSON by the /metrics route
+in app.py, see snapshot().
+
+Setting PROFILE_DIR turns on the cProfile dump mode: every run of a stage listed in PROFILE_STAGES
+(comma-separated, default all) is profiled and dumped to PROFILE_DIR/<stage>-<timestamp in ns>.prof,
+to be read with pstats or snakeviz. Profiling is skipped for stages that run inside an already profiled one
+"""
+
+import contextlib
+import cProfile
+import os
+import threading
+import time
+
+PROFILE_DIR = os.environ.get('PROFILE_DIR')
+PROFILE_STAGES = {stage for stage in os.environ.get('PROFILE_STAGES', '').split(',') if stage}
+
+_lock = threading.Lock()
+_timings = {}  # stage -> {'count', 'total', 'max', 'last'} in seconds
+_counters = {}  # event -> count
+_profiling = threading.Lock()  # Held while a stage is being profiled, cProfile can't nest
+
+
+def _record(stage, seconds):
+    with _lock:
+        timing = _timings.setdefault(stage, {'count': 0, 'total': 0.0, 'max': 0.0, 'last': 0.0})
+        timing['count'] += 1
+        timing['total'] += seconds
+        timing['max'] = max(timing['max'], seconds)
+        timing['last'] = seconds
+
+
+def _should_profile(stage):
+    return PROFILE_DIR is not None and (not PROFILE_STAGES or stage in PROFILE_STAGES)
+
+
+@contextlib.contextmanager
+def timed(stage):
+    """
+    Times the block (or every call of the decorated function) under stage
+    """
+    profiler = None
+    if _should_profile(stage) and _profiling.acquire(blocking=False):
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record(stage, time.perf_counter() - start)
+
+        if profiler is not None:
+            profiler.disable()
+            _profiling.release()
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            profiler.dump_stats(os.path.join(PROFILE_DIR, f'{stage}-{time.time_ns()}.prof'))
+
+
+def count(event, n=1):
+    with _lock:
+        _counters[event] = _counters.get(event, 0) + n
+
+
+def snapshot():
+    """
+    Returns {'timings': {stage: {count, total, mean, max, last}}, 'counters': {event: count}}, times in ms
+    """
+    with _lock:
+        timings = {
+            stage: {
+                'count': timing['count'],
+                'total_ms': timing['total'] * 1000,
+                'mean_ms': timing['total'] / timing['count'] * 1000,
+                'max_ms': timing['max'] * 1000,
+                'last_ms': timing['last'] * 1000,
+            }
+            for stage, timing in sorted(_timings.items())
+        }
+        return {'pid': os.getpid(), 'timings': timings, 'counters': dict(sorted(_counters.items()))}
+
+
+def reset():
+    with _lock:
+        _timings.clear()
+        _counters.clear()
@@ -0,0 +1,98 @@
+"""
+Background refresh of the dashboard data and figures.
+
+Callbacks never parse or compute anything themselves: they read the last good Snapshot, which a refresh job
+replaces as a whole (one reference swap) once the new data and every figure are built. Jobs run on a single
+background thread, so a request never waits for a refresh, and request_refresh() only starts a job when none
+is running and the last one started at least REFRESH_INTERVAL seconds ago: any number of concurrent requests
+cause at most one refresh. Across gunicorn workers, the shared store (see store_utils) makes sure only one of
+them parses the workbooks.
+"""
+
+import os
+import threading
+import time
+import traceback
+from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from dash_utils import create_dashboard_figures
+from data_utils import index_metrics
+from metrics_utils import count, timed
+from store_utils import get_shared_dfs
+
+# Seconds between checks for changed annotation files
+REFRESH_INTERVAL = float(os.environ.get('REFRESH_INTERVAL', 5))
+# Set BACKGROUND_REFRESH=0 to run refreshes in the requesting thread instead
+BACKGROUND_REFRESH = os.environ.get('BACKGROUND_REFRESH', '1') != '0'
+
+# version: annotations_version of data, index: its MetricIndex, figures: create_dashboard_figures output
+Snapshot = namedtuple('Snapshot', ['version', 'data', 'index', 'figures'])
+
+# Set once the first snapshot is in
+ready = threading.Event()
+
+_current = {'snapshot': None}
+_job = {'future': None, 'started': None}
+_job_lock = threading.Lock()
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='refresh')
+
+
+@timed('refresh')
+def _refresh(version):
+    # The refresh job: brings the shared store up to date and swaps in a new snapshot if it moved past version
+    try:
+        new_version, data = get_shared_dfs()
+        if new_version != version:
+            index = index_metrics(data)
+            _current['snapshot'] = Snapshot(new_version, data, index, create_dashboard_figures(data, index))
+            count('refresh.swapped')
+            ready.set()
+            print('snapshot', new_version, 'ready')
+    except Exception:
+        # Keep serving the last good snapshot
+        count('refresh.failed')
+        traceback.print_exc()
+        raise
+
+
+def request_refresh():
+    """
+    Starts a refresh job, unless one is already running (returns its future) or the last one started less
+    than REFRESH_INTERVAL seconds ago (returns None)
+    """
+    with _job_lock:
+        future = _job['future']
+        if future is not None and not future.done():
+            count('refresh.deduplicated')
+            return future
+        if _job['started'] is not None and time.monotonic() - _job['started'] < REFRESH_INTERVAL:
+            return None
+
+        _job['started'] = time.monotonic()
+        snapshot = _current['snapshot']
+        version = snapshot.version if snapshot is not None else None
+        count('refresh.started')
+
+        if BACKGROUND_REFRESH:
+            future = _executor.submit(_refresh, version)
+        else:
+            future = Future()
+        _job['future'] = future
+
+    if not BACKGROUND_REFRESH:
+        try:
+            future.set_result(_refresh(version))
+        except Exception as error:
+            future.set_exception(error)
+
+    return future
+
+
+def current_snapshot():
+    """
+    Returns the last good Snapshot right away (None before the first one is in),
+    and checks for changed annotations in the background
+    """
+    request_refresh()
+    return _current['snapshot']
@@ -1,115 +1,97 @@
 """
 Script to calculate statistics
+
+Averages the pairwise kappa scores of each round into within-group and between-group agreement, next to the
+multi-rater agreement of the whole round, and writes one row per (category, round).
+Reuses the dashboard's shared store (see store_utils), so nothing is parsed again unless the annotations changed.
+
+Usage:
+    python statistics.py [--rounds 1 2 3] [--categories Humanlikeness ...] [--output iaa_stats.xlsx]
+The output format follows the extension: .xlsx, .csv or .parquet
 """
-import pandas as pd
+import argparse
+import os
+
 import numpy as np
-from pandas import CategoricalDtype
-from data_utils import read_data, calculate_group_kappa
-import math
-ANNOTATION_CATEGORIES = ['Appropriateness', 'Information content of outputs', 'Humanlikeness']
-
-initial_data = read_data()
-data = calculate_group_kappa(initial_data)
-
-category_list = []
-round_list = []
-within_list = []
-between_list = []
-
-for category in ANNOTATION_CATEGORIES:
-
-    
-    print('category:', category)
-    for idx, round in enumerate(data.keys()):
-
-        within_group_scores = []
-        between_group_scores = []
-        # if round > 3:
-        #     break
-        round_data = data[round][category]
-
-        for i in range(len(round_data)):
-            for j in range(len(round_data)):
-                score = round_data[i][j]
-                
-                if math.isnan(score):
-                    continue
-                # Find within group agreement
-                if (i % 2 == 0) and (i + 1 == j):
-                    within_group_scores.append(score)
-                else:
-                    between_group_scores.append(score)
-        print('----------')
-        print(f'round {str(round)}')
-        print('within group:', sum(within_group_scores)/len(within_group_scores))
-        print('between group:', sum(between_group_scores)/len(between_group_scores))
-        
-        category_list.append(category)
-        round_list.append(round)
-        within_list.append(sum(within_group_scores)/len(within_group_scores))
-        between_list.append(sum(between_group_scores)/len(between_group_scores))
-
-df = pd.DataFrame({
-    'category': category_list,
-    'round': round_list,
-    'within': within_list,
-    'between': between_list
-})
-
-df.to_excel('iaa_stats.xlsx', engine='openpyxl')
-
-
-    # fig.add_trace(
-    #     go.Heatmap(
-    #         x=[f"Rater {group_no + 1}" for group_no in range(len(round_data))],
-    #         y=[f"Rater {group_no + 1}" for group_no in range(len(round_data))],
-    #         z=round_data,
-    #         type='heatmap',
-    #         hoverongaps=False,
-    #         coloraxis='coloraxis',
-    #         text=round_data,
-    #         texttemplate="%{text:.2f}",
-    #         textfont={"size": 10}
-    #     ), 1, idx + 1
-    # )
-
-
-
-def create_heatmap_kappa(data, category):
-    fig = make_subplots(
-        1,
-        6,
-        # len(data.keys()),
-        vertical_spacing=0.05,
-        horizontal_spacing=0.05,
-        # shared_yaxes=True,
-        # subplot_titles=[f"Round {i}" for i in data.keys()]
-        subplot_titles=[f"Round 1", "Round 2", "Round 3", "Round 4", "Round 5", "Round 6"]
-    )
-
-    # Patches to add emphasis on groups
-
-    for idx, round in enumerate(data.keys()):
-        # if round > 3:
-        #     break
-        round_data = data[round][category]
-
-        fig.add_trace(
-            go.Heatmap(
-                x=[f"Rater {group_no + 1}" for group_no in range(len(round_data))],
-                y=[f"Rater {group_no + 1}" for group_no in range(len(round_data))],
-                z=round_data,
-                type='heatmap',
-                hoverongaps=False,
-                coloraxis='coloraxis',
-                text=round_data,
-                texttemplate="%{text:.2f}",
-                textfont={"size": 10}
-            ), 1, idx + 1
-        )
-
-    fig.update_layout(
-        coloraxis={'colorscale': 'PuBu'},
-    )
-
-    return fig
\ No newline at end of file
+import pandas as pd
+
+from data_utils import ANNOTATION_CATEGORIES
+from store_utils import get_shared_dfs
+
+OUTPUT_WRITERS = {
+    '.xlsx': lambda df, path: df.to_excel(path, engine='openpyxl'),
+    '.csv': lambda df, path: df.to_csv(path),
+    '.parquet': lambda df, path: df.to_parquet(path),
+}
+
+
+def within_between_kappa(group_kappa, raters, rounds=None, categories=ANNOTATION_CATEGORIES):
+    """
+    Averages each round's pairwise kappa matrix over pairs in the same group (within) and in different groups
+    (between), using masks over the whole matrix instead of looping over its cells
+    """
+    rounds = list(rounds if rounds is not None else group_kappa.keys())
+    within = np.full((len(categories), len(rounds)), np.nan)
+    between = np.full((len(categories), len(rounds)), np.nan)
+
+    for round_idx, round in enumerate(rounds):
+        round_groups = raters[raters['round'] == round].sort_values('rater')['group'].to_numpy()
+
+        # (category, rater, rater), NaN outside the upper triangle
+        round_data = np.stack([np.asarray(group_kappa[round][category]) for category in categories])
+        scored = ~np.isnan(round_data)
+        same_group = round_groups[:, None] == round_groups[None, :]
+
+        with np.errstate(invalid='ignore'):
+            for scores, mask in [(within, scored & same_group), (between, scored & ~same_group)]:
+                scores[:, round_idx] = np.where(mask, round_data, 0).sum(axis=(1, 2)) / mask.sum(axis=(1, 2))
+
+    # One block of rounds per category
+    return pd.DataFrame({
+        'category': np.repeat(categories, len(rounds)),
+        'round': np.tile(rounds, len(categories)),
+        'within': within.ravel(),
+        'between': between.ravel(),
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inter-annotator agreement statistics per round')
+    parser.add_argument('--rounds', type=int, nargs='+', help='Rounds to report (default: all)')
+    parser.add_argument('--categories', nargs='+', choices=ANNOTATION_CATEGORIES, default=ANNOTATION_CATEGORIES,
+                        help='Annotation categories to report (default: all)')
+    parser.add_argument('--output', default='iaa_stats.xlsx', help='Output file, .xlsx, .csv or .parquet')
+    args = parser.parse_args()
+
+    extension = os.path.splitext(args.output)[1].lower()
+    if extension not in OUTPUT_WRITERS:
+        parser.error(f'unsupported output format {extension!r}, use one of {sorted(OUTPUT_WRITERS)}')
+
+    _, data = get_shared_dfs()
+
+    rounds = args.rounds if args.rounds is not None else list(data.group_kappa.keys())
+    missing = sorted(set(rounds) - set(data.group_kappa.keys()))
+    if missing:
+        parser.error(f'no annotations for round(s) {missing}')
+
+    df = within_between_kappa(data.group_kappa, data.raters, rounds, args.categories)
+
+    # Agreement between everyone in the round (Fleiss' kappa, Krippendorff's alpha)
+    multi_rater = pd.DataFrame(data.multi_rater).astype({'category': str})
+    df = df.merge(multi_rater[['category', 'round', 'fleiss_kappa', 'krippendorff_alpha']], on=['category', 'round'],
+                  how='left')
+
+    for category, category_df in df.groupby('category', sort=False):
+        print('category:', category)
+        for row in category_df.itertuples():
+            print('----------')
+            print(f'round {row.round}')
+            print('within group:', row.within)
+            print('between group:', row.between)
+
+    OUTPUT_WRITERS[extension](df, args.output)
+    print(f'wrote {len(df)} rows to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
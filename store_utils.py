@@ -0,0 +1,274 @@
+"""
+Shared, memory-mapped store of the get_dfs outputs.
+
+Every gunicorn worker used to parse all workbooks and hold its own copy of every DataFrame and kappa matrix.
+Instead, one worker (whoever holds the store lock) computes the outputs and writes them to STORE_DIR as plain
+.npy files plus a small index.json, and every worker maps those files read-only. Pages of a mapped file are
+shared between processes, so adding workers doesn't add copies of the data.
+
+Layout:
+    STORE_DIR/CURRENT           name of the current version directory, replaced atomically
+    STORE_DIR/<version>/        index.json + one .npy per array / DataFrame column
+    STORE_DIR/.rounds/<key>/    the same, for the outputs of one round (see data_utils.get_versioned_dfs)
+
+A version directory only names the annotations it was computed from. index.json also records the store_format
+of the code that wrote it, and a store written by other code (new fields, new frame columns, changed metrics)
+counts as out of date even when the annotations are the same.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from collections.abc import MutableMapping
+
+import numpy as np
+import pandas as pd
+
+import data_utils
+from data_utils import DashboardData, annotations_version, get_versioned_dfs
+from metrics_utils import count, timed
+
+STORE_DIR = './.annotation_store'
+# Versions kept around, so workers that just read CURRENT can still open the previous one
+KEEP_VERSIONS = 2
+# Bump when the layout of the store itself changes (see write_store / load_store)
+STORE_FORMAT = 1
+
+
+def store_format():
+    # A digest of STORE_FORMAT, the DashboardData fields and the code computing them (data_utils), so any change
+    # to what gets written (a new field, a new frame column, a fixed metric) invalidates stores written before it
+    digest = hashlib.sha1(f'{STORE_FORMAT}:{",".join(DashboardData._fields)}:'.encode('utf-8'))
+    with open(data_utils.__file__, 'rb') as f:
+        digest.update(f.read())
+    return digest.hexdigest()
+
+
+# The store this process has mapped
+_mapped = {'version': None, 'data': None}
+_mapped_lock = threading.Lock()
+
+
+def _save_frame(directory, name, df):
+    # One .npy per column. Text columns are stored as integer codes, their labels go in the index
+    columns = []
+    for idx, column in enumerate(df.columns):
+        values = df[column]
+        entry = {'name': column, 'file': f'{name}.{idx}.npy', 'labels': None}
+        if not pd.api.types.is_numeric_dtype(values):
+            codes, labels = pd.factorize(values)
+            values = codes.astype(np.int32)
+            entry['labels'] = labels.tolist()
+        np.save(os.path.join(directory, entry['file']), np.asarray(values))
+        columns.append(entry)
+
+    return {'kind': 'frame', 'columns': columns}
+
+
+def _load_frame(directory, entry):
+    columns = {}
+    for column in entry['columns']:
+        # np.asarray drops the memmap subclass, without copying
+        values = np.asarray(np.load(os.path.join(directory, column['file']), mmap_mode='r'))
+        if column['labels'] is not None:
+            values = pd.Categorical.from_codes(values, categories=column['labels'])
+        columns[column['name']] = values
+
+    return pd.DataFrame(columns, copy=False)
+
+
+def _save_round_matrices(directory, name, data):
+    # {round: {category: (n, n) matrix}} -> one padded (round, category, n, n) array
+    rounds = list(data.keys())
+    categories = list(next(iter(data.values()), {}).keys())
+    sizes = [len(next(iter(data[ROUND_NUMBER].values()), [])) for ROUND_NUMBER in rounds]
+
+    stacked = np.full((len(rounds), len(categories), max(sizes, default=0), max(sizes, default=0)), np.nan)
+    for round_idx, ROUND_NUMBER in enumerate(rounds):
+        for category_idx, category in enumerate(categories):
+            stacked[round_idx, category_idx, :sizes[round_idx], :sizes[round_idx]] = data[ROUND_NUMBER][category]
+    np.save(os.path.join(directory, f'{name}.npy'), stacked)
+
+    return {'kind': 'round_matrices', 'file': f'{name}.npy', 'rounds': [int(r) for r in rounds],
+            'categories': categories, 'sizes': sizes}
+
+
+def _load_round_matrices(directory, entry):
+    # Every matrix is a view into the one mapped array
+    stacked = np.load(os.path.join(directory, entry['file']), mmap_mode='r')
+    return {
+        ROUND_NUMBER: {
+            category: stacked[round_idx, category_idx, :size, :size]
+            for category_idx, category in enumerate(entry['categories'])
+        }
+        for round_idx, (ROUND_NUMBER, size) in enumerate(zip(entry['rounds'], entry['sizes']))
+    }
+
+
+def _save_fields(directory, version, data):
+    # Writes every field of a DashboardData to directory, with an index.json describing them
+    index = {'version': version, 'format': store_format(), 'fields': {}}
+    for name, value in zip(data._fields, data):
+        if isinstance(value, pd.DataFrame):
+            index['fields'][name] = _save_frame(directory, name, value)
+        elif isinstance(value, dict):
+            index['fields'][name] = _save_round_matrices(directory, name, value)
+        else:
+            np.save(os.path.join(directory, f'{name}.npy'), np.asarray(value))
+            index['fields'][name] = {'kind': 'array', 'file': f'{name}.npy'}
+
+    with open(os.path.join(directory, 'index.json'), 'w') as f:
+        json.dump(index, f)
+
+
+def _load_fields(directory):
+    # Maps every field written by _save_fields read-only
+    with open(os.path.join(directory, 'index.json')) as f:
+        index = json.load(f)
+
+    fields = {}
+    for name, entry in index['fields'].items():
+        if entry['kind'] == 'frame':
+            fields[name] = _load_frame(directory, entry)
+        elif entry['kind'] == 'round_matrices':
+            fields[name] = _load_round_matrices(directory, entry)
+        else:
+            fields[name] = np.load(os.path.join(directory, entry['file']), mmap_mode='r')
+
+    return DashboardData(**fields)
+
+
+def _is_written(directory):
+    # Whether directory holds a DashboardData written by this code, see store_format
+    try:
+        with open(os.path.join(directory, 'index.json')) as f:
+            index = json.load(f)
+    except FileNotFoundError:
+        return False
+    return index.get('format') == store_format() and list(index['fields']) == list(DashboardData._fields)
+
+
+@timed('write_store')
+def write_store(version, data):
+    """
+    Writes a DashboardData to STORE_DIR/<version> and points CURRENT at it.
+    Callers must hold the store lock
+    """
+    os.makedirs(STORE_DIR, exist_ok=True)
+
+    # Build the version directory under a temporary name, then rename it into place
+    directory = tempfile.mkdtemp(dir=STORE_DIR, prefix='.tmp-')
+    _save_fields(directory, version, data)
+
+    final_directory = os.path.join(STORE_DIR, version)
+    if os.path.exists(final_directory):
+        shutil.rmtree(final_directory)
+    os.rename(directory, final_directory)
+
+    # Swap CURRENT in a single rename, so readers see either the old or the new version
+    fd, pointer = tempfile.mkstemp(dir=STORE_DIR, prefix='.tmp-')
+    with os.fdopen(fd, 'w') as f:
+        f.write(version)
+    os.replace(pointer, os.path.join(STORE_DIR, 'CURRENT'))
+
+    # Drop old versions (mapped files stay readable for processes that still have them open)
+    versions = sorted((entry for entry in os.scandir(STORE_DIR) if entry.is_dir() and not entry.name.startswith('.')),
+                      key=lambda entry: entry.stat().st_mtime, reverse=True)
+    for entry in versions[KEEP_VERSIONS:]:
+        shutil.rmtree(entry.path, ignore_errors=True)
+
+
+def current_version():
+    try:
+        with open(os.path.join(STORE_DIR, 'CURRENT')) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def _is_current(version):
+    # A store written by other code has the right version but not necessarily the right fields or columns
+    return current_version() == version and _is_written(os.path.join(STORE_DIR, version))
+
+
+@timed('load_store')
+def load_store(version):
+    """
+    Maps STORE_DIR/<version> read-only and returns it as a DashboardData
+    """
+    return _load_fields(os.path.join(STORE_DIR, version))
+
+
+class RoundStore(MutableMapping):
+    """
+    The outputs of each round, for get_versioned_dfs, kept in STORE_DIR/.rounds instead of process memory:
+    setting a round writes it, getting one maps it read-only. Only the process holding the store lock uses it
+    """
+
+    def _directory(self, key):
+        return os.path.join(STORE_DIR, '.rounds', key)
+
+    def __getitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        return _load_fields(self._directory(key))
+
+    def __setitem__(self, key, data):
+        os.makedirs(os.path.join(STORE_DIR, '.rounds'), exist_ok=True)
+        directory = tempfile.mkdtemp(dir=os.path.join(STORE_DIR, '.rounds'), prefix='.tmp-')
+        _save_fields(directory, key, data)
+        shutil.rmtree(self._directory(key), ignore_errors=True)
+        os.rename(directory, self._directory(key))
+
+    def __delitem__(self, key):
+        shutil.rmtree(self._directory(key), ignore_errors=True)
+
+    def __contains__(self, key):
+        return _is_written(self._directory(key))
+
+    def __iter__(self):
+        try:
+            return iter([entry.name for entry in os.scandir(os.path.join(STORE_DIR, '.rounds'))
+                         if entry.is_dir() and not entry.name.startswith('.')])
+        except FileNotFoundError:
+            return iter([])
+
+    def __len__(self):
+        return len(list(iter(self)))
+
+
+def get_shared_dfs():
+    """
+    Returns (version, get_dfs output) backed by the shared store, refreshing the store first if the
+    annotations changed. Only the process holding the store lock recomputes, the others wait and map its result
+    """
+    version = annotations_version()
+
+    with _mapped_lock:
+        if _mapped['version'] == version:
+            count('shared_store.hit')
+            return version, _mapped['data']
+
+        count('shared_store.miss')
+        if not _is_current(version):
+            os.makedirs(STORE_DIR, exist_ok=True)
+            with open(os.path.join(STORE_DIR, '.lock'), 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    # Another worker might have refreshed the store while we waited for the lock
+                    if not _is_current(version):
+                        print('writing shared store')
+                        # Only the mapped copy is kept: the round outputs stay in the store, and the merged
+                        # output is dropped once written
+                        version, data = get_versioned_dfs(RoundStore(), keep=False)
+                        write_store(version, data)
+                        del data
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+        _mapped['version'], _mapped['data'] = version, load_store(version)
+        return version, _mapped['data']